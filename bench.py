@@ -0,0 +1,298 @@
+# ===== Sleepy Bot • Benchmark offline =====
+# Đo các lệnh nặng trên DB giả, không cần kết nối Discord:
+#   python bench.py                       # 1k, 100k, 1M dòng
+#   python bench.py --scales 1000,100000 --guilds 5 --output bench_output.txt
+# Sinh dữ liệu rồi mỗi benchmark chạy trong process riêng trên cùng DB, để peak RSS
+# của bench này không lẫn với bench trước (ru_maxrss là peak suốt đời process).
+# ============================================
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+DAY = 86400
+DEFAULT_SCALES = "1000,100000,1000000"
+# ingest ghi vào DB nên chạy cuối
+BENCHES = ("startup", "status", "recheck30days", "list_off", "exportcsv", "ingest")
+GENERATE_CHUNK = 50_000
+
+# ===== Sinh dữ liệu giả =====
+async def generate(path: str, rows: int, guilds: int, seed: int, max_days: int = 120):
+    """Đổ `rows` dòng inactivity (kèm tên hiển thị) chia đều cho `guilds` server."""
+    from db import Database
+
+    rng = random.Random(seed)
+    now = int(time.time())
+    database = Database(path)
+    await database.open()
+
+    def _insert(conn, seen_rows, name_rows):
+        conn.executemany("""INSERT INTO inactivity (guild_id, member_id, last_seen, role_added)
+                            VALUES (?, ?, ?, ?)""", seen_rows)
+        conn.executemany("""INSERT INTO member_names (guild_id, member_id, display_name, updated_at)
+                            VALUES (?, ?, ?, ?)""", name_rows)
+
+    seen_rows, name_rows = [], []
+    for i in range(rows):
+        guild_id = 1 + i % guilds
+        member_id = 10_000_000 + i
+        last_seen = now - rng.randrange(max_days * DAY)
+        role_added = last_seen + 30 * DAY if now - last_seen > 30 * DAY else None
+        seen_rows.append((guild_id, member_id, last_seen, role_added))
+        name_rows.append((guild_id, member_id, f"member_{member_id}", now))
+        if len(seen_rows) >= GENERATE_CHUNK:
+            await database.write(_insert, seen_rows, name_rows)
+            seen_rows, name_rows = [], []
+    if seen_rows:
+        await database.write(_insert, seen_rows, name_rows)
+    await database.close()
+
+# ===== Stub Discord =====
+class StubRole(SimpleNamespace):
+    pass
+
+class StubGuild:
+    def __init__(self, guild_id: int, role_name: str):
+        self.id = guild_id
+        self.name = f"bench-guild-{guild_id}"
+        self.roles = [StubRole(id=guild_id * 10, name="@everyone"),
+                      StubRole(id=guild_id * 10 + 1, name=role_name)]
+        self.filesize_limit = 25 * 1024 * 1024
+        self.members = []
+
+    def get_member(self, member_id: int):
+        # Như guild chưa chunk member: tên phải lấy từ LRU/DB
+        return None
+
+class StubMessage:
+    def __init__(self, message_id: int, ephemeral: bool):
+        self.id = message_id
+        self.flags = SimpleNamespace(ephemeral=ephemeral)
+
+class StubResponse:
+    def __init__(self):
+        self.ephemeral = False
+
+    async def defer(self, *, ephemeral: bool = False, thinking: bool = False):
+        self.ephemeral = ephemeral
+
+    async def send_message(self, content=None, *, ephemeral: bool = False, **kwargs):
+        self.ephemeral = ephemeral
+
+class StubFollowup:
+    def __init__(self, response: StubResponse):
+        self.response = response
+        self.sent = 0
+        self.bytes = 0
+        self._next_id = 1
+
+    async def send(self, content=None, *, ephemeral: bool = None, file=None, **kwargs):
+        if file is not None:
+            file.fp.seek(0, os.SEEK_END)
+            self.bytes += file.fp.tell()
+        self.sent += 1
+        self._next_id += 1
+        return StubMessage(self._next_id, self.response.ephemeral if ephemeral is None else ephemeral)
+
+class StubInteraction:
+    def __init__(self, guild: StubGuild):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel_id = guild.id * 100
+        self.token = "bench"
+        self.user = SimpleNamespace(id=1, name="bench")
+        self.response = StubResponse()
+        self.followup = StubFollowup(self.response)
+
+class StubMember(SimpleNamespace):
+    pass
+
+# ===== Đo =====
+class LoopBlockMonitor:
+    """Đo khoảng block dài nhất của event loop bằng một task ngủ `interval` giây."""
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.longest = 0.0
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.longest = max(self.longest, loop.time() - started - self.interval)
+
+    def __enter__(self):
+        self.longest = 0.0
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+def reset_peak_rss():
+    # Linux: ghi "5" vào clear_refs đặt VmHWM về RSS hiện tại
+    with contextlib.suppress(OSError):
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+
+def rss_mb() -> tuple:
+    """(RSS hiện tại, peak RSS) tính bằng MB, đọc từ /proc/self/status."""
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        # Không có /proc: chỉ còn peak suốt đời process (ru_maxrss tính bằng KB trên Linux)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak, peak
+
+async def measure(name: str, fn, repeat: int, results: list):
+    reset_peak_rss()
+    baseline, _ = rss_mb()
+    timings, blocks, extra = [], [], {}
+    for _ in range(repeat):
+        with LoopBlockMonitor() as monitor:
+            started = time.perf_counter()
+            extra = await fn() or {}
+            timings.append(time.perf_counter() - started)
+            await asyncio.sleep(0)
+        blocks.append(monitor.longest)
+    _, peak = rss_mb()
+    results.append({"bench": name, "best_s": min(timings), "median_s": statistics.median(timings),
+                    "max_block_ms": max(blocks) * 1000, "peak_rss_mb": peak,
+                    "rss_delta_mb": peak - baseline, **extra})
+
+async def run_bench(bench: str, path: str, rows: int, guilds: int, seed: int, repeat: int,
+                    events: int) -> list:
+    """Chạy một benchmark (hoặc "generate") trên DB ở `path`; gọi trong process worker."""
+    results = []
+    if bench == "generate":
+        await measure("generate", lambda: generate(path, rows, guilds, seed), 1, results)
+        return results
+
+    # sleepbot đọc DB_PATH lúc import
+    os.environ["DB_PATH"] = path
+    import sleepbot
+
+    # Như setup_hook nhưng bỏ phần sync command (cần mạng)
+    sleepbot.db.on_query = sleepbot.observe_query
+
+    async def startup():
+        await sleepbot.db.open()
+        await sleepbot.settings.load()
+        await sleepbot.rebuild_state_from_db()
+        await sleepbot.autodelete.load()
+
+    if bench == "startup":
+        await measure("startup", startup, 1, results)
+    else:
+        await startup()
+
+    guild = StubGuild(1, sleepbot.settings.get(1).role_name)
+
+    async def status():
+        await sleepbot.slash_status.callback(StubInteraction(guild))
+
+    async def recheck30days():
+        await sleepbot.recheck30days.callback(StubInteraction(guild))
+
+    async def list_off():
+        interaction = StubInteraction(guild)
+        await sleepbot.list_off.callback(interaction, days=30)
+        return {"messages": interaction.followup.sent}
+
+    async def exportcsv():
+        interaction = StubInteraction(guild)
+        await sleepbot.exportcsv.callback(interaction, scope="server", days=0)
+        return {"messages": interaction.followup.sent, "bytes": interaction.followup.bytes}
+
+    rng = random.Random(seed)
+    online = sleepbot.discord.Status.online
+    stub_guilds = [SimpleNamespace(id=1 + g) for g in range(guilds)]
+
+    async def ingest():
+        n = min(events, rows)
+        for _ in range(n):
+            i = rng.randrange(rows)
+            member = StubMember(id=10_000_000 + i, bot=False, status=online,
+                                guild=stub_guilds[i % guilds])
+            await sleepbot.on_presence_update(member, member)
+        flushed = await sleepbot.tracker.flush()
+        return {"events": n, "flushed": flushed}
+
+    benches = {"status": status, "recheck30days": recheck30days, "list_off": list_off,
+               "exportcsv": exportcsv, "ingest": ingest}
+    if bench in benches:
+        await measure(bench, benches[bench], repeat, results)
+
+    await sleepbot.tracker.close()
+    await sleepbot.settings.flush()
+    await sleepbot.db.close()
+    return results
+
+# ===== Báo cáo =====
+def format_table(results: list) -> str:
+    header = (f"{'rows':>9} {'bench':<14} {'best s':>9} {'median s':>9} {'block ms':>9} "
+              f"{'RSS MB':>8} {'Δ MB':>8}  extra")
+    lines = [header, "-" * len(header)]
+    for r in results:
+        extra = " ".join(f"{k}={r[k]}" for k in ("messages", "bytes", "events", "flushed") if k in r)
+        if "events" in r and r["median_s"]:
+            extra += f" ({r['events'] / r['median_s']:,.0f} ev/s)"
+        lines.append(f"{r['rows']:>9} {r['bench']:<14} {r['best_s']:>9.4f} {r['median_s']:>9.4f} "
+                     f"{r['max_block_ms']:>9.1f} {r['peak_rss_mb']:>8.1f} {r['rss_delta_mb']:>8.1f}  {extra}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Sleepy Bot offline với dữ liệu giả.")
+    parser.add_argument("--scales", default=DEFAULT_SCALES, help="Số dòng inactivity, cách nhau bởi dấu phẩy")
+    parser.add_argument("--guilds", type=int, default=1, help="Số server giả (dòng chia đều)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần chạy mỗi benchmark")
+    parser.add_argument("--events", type=int, default=100_000, help="Số event presence cho bench ingest")
+    parser.add_argument("--output", help="Ghi bảng kết quả vào file (vd. bench_output.txt)")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        results = asyncio.run(run_bench(args.worker, args.db, args.rows, args.guilds, args.seed,
+                                        args.repeat, args.events))
+        print(json.dumps(results))
+        return
+
+    results = []
+    for rows in (int(x) for x in args.scales.split(",")):
+        print(f"⏱️ Đang chạy scale {rows:,} dòng...", file=sys.stderr)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "inactivity.db")
+            for bench in ("generate",) + BENCHES:
+                proc = subprocess.run(
+                    [sys.executable, __file__, "--worker", bench, "--rows", str(rows), "--db", path,
+                     "--guilds", str(args.guilds), "--seed", str(args.seed),
+                     "--repeat", str(args.repeat), "--events", str(args.events)],
+                    stdout=subprocess.PIPE, text=True, check=True)
+                for result in json.loads(proc.stdout.strip().splitlines()[-1]):
+                    results.append({"rows": rows, **result})
+
+    table = format_table(results)
+    print(table)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(table + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,591 @@
+# ===== Sleepy Bot • Lớp truy cập SQLite =====
+# Toàn bộ truy vấn chạy trên thread riêng, event loop của bot không bao giờ chờ I/O:
+# - 1 connection ghi (WAL) dùng chung, chạy tuần tự trên 1 thread
+# - pool connection đọc, mỗi thread đọc giữ 1 connection
+# Schema/migration chạy một lần trong Database.open() lúc khởi động.
+# ============================================
+
+import asyncio
+import calendar
+import gzip
+import os
+import queue
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ===== Schema & migration =====
+# PRAGMA user_version = số migration đã chạy. Thêm migration mới vào cuối list.
+def _migrate_v1(conn):
+    """inactivity: khóa (guild_id, member_id) INTEGER, last_seen epoch, index theo guild."""
+    legacy = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'inactivity'"
+    ).fetchone()
+    if legacy:
+        conn.execute("ALTER TABLE inactivity RENAME TO inactivity_legacy")
+    conn.execute("""CREATE TABLE inactivity (
+                        guild_id INTEGER NOT NULL,
+                        member_id INTEGER NOT NULL,
+                        last_seen INTEGER NOT NULL,
+                        role_added INTEGER,
+                        PRIMARY KEY (guild_id, member_id)
+                    ) WITHOUT ROWID""")
+    if legacy:
+        # Dữ liệu cũ: id dạng TEXT, thời gian dạng ISO. Dòng trùng gộp lại, giữ bản mới nhất;
+        # last_seen không đọc được thì coi như rất cũ (0) thay vì bỏ dòng.
+        conn.execute("""INSERT INTO inactivity (guild_id, member_id, last_seen, role_added)
+                        SELECT CAST(guild_id AS INTEGER), CAST(member_id AS INTEGER),
+                               MAX(COALESCE(CAST(strftime('%s', last_seen) AS INTEGER), 0)),
+                               MAX(CASE
+                                   WHEN role_added IS NULL
+                                        OR TRIM(role_added) IN ('', '0', 'False', 'false', 'None')
+                                   THEN NULL
+                                   ELSE COALESCE(CAST(strftime('%s', role_added) AS INTEGER),
+                                                 CAST(strftime('%s', last_seen) AS INTEGER), 0)
+                               END)
+                        FROM inactivity_legacy
+                        GROUP BY CAST(guild_id AS INTEGER), CAST(member_id AS INTEGER)""")
+        conn.execute("DROP TABLE inactivity_legacy")
+    conn.execute("CREATE INDEX idx_inactivity_guild_seen ON inactivity(guild_id, last_seen)")
+
+def _migrate_v2(conn):
+    """Trạng thái sweep gán role (resume được) + index cho thành viên đang có role."""
+    conn.execute("""CREATE TABLE sweep_state (
+                        guild_id INTEGER PRIMARY KEY,
+                        phase TEXT NOT NULL,
+                        cursor INTEGER NOT NULL,
+                        cutoff INTEGER NOT NULL,
+                        started_at INTEGER NOT NULL
+                    )""")
+    conn.execute("""CREATE INDEX idx_inactivity_role ON inactivity(guild_id, member_id)
+                    WHERE role_added IS NOT NULL""")
+
+def _migrate_v3(conn):
+    """Bỏ sweep_state và index role của nó: hàng đợi hết hạn trong RAM dựng lại từ role_added."""
+    conn.execute("DROP TABLE sweep_state")
+    conn.execute("DROP INDEX idx_inactivity_role")
+
+def _migrate_v4(conn):
+    """member_names: tên hiển thị cuối cùng biết được, kể cả người đã rời server."""
+    conn.execute("""CREATE TABLE member_names (
+                        guild_id INTEGER NOT NULL,
+                        member_id INTEGER NOT NULL,
+                        display_name TEXT NOT NULL,
+                        updated_at INTEGER NOT NULL,
+                        PRIMARY KEY (guild_id, member_id)
+                    ) WITHOUT ROWID""")
+
+def _migrate_v5(conn):
+    """meta: key/value nhỏ của bot (hash command tree đã sync, ...)."""
+    conn.execute("""CREATE TABLE meta (
+                        key TEXT PRIMARY KEY,
+                        value TEXT NOT NULL
+                    )""")
+
+def _migrate_v6(conn):
+    """guild_settings: cấu hình theo guild; guild_id = 0 là mặc định toàn cục."""
+    conn.execute("""CREATE TABLE guild_settings (
+                        guild_id INTEGER PRIMARY KEY,
+                        inactive_days INTEGER NOT NULL,
+                        role_name TEXT NOT NULL,
+                        auto_delete_enabled INTEGER NOT NULL,
+                        auto_delete_delay INTEGER NOT NULL,
+                        excluded_roles TEXT NOT NULL DEFAULT '[]',
+                        updated_at INTEGER NOT NULL
+                    )""")
+
+def _migrate_v7(conn):
+    """autodelete_queue: tin nhắn chờ tự xóa, sống sót qua restart.
+
+    token != NULL nghĩa là tin ephemeral, xóa qua webhook của interaction.
+    """
+    conn.execute("""CREATE TABLE autodelete_queue (
+                        channel_id INTEGER NOT NULL,
+                        message_id INTEGER NOT NULL,
+                        due REAL NOT NULL,
+                        token TEXT,
+                        PRIMARY KEY (channel_id, message_id)
+                    ) WITHOUT ROWID""")
+
+def _migrate_v8(conn):
+    """activity_daily / activity_weekly: tổng hợp theo guild từ các bảng activity_YYYYMMDD."""
+    conn.execute("""CREATE TABLE activity_daily (
+                        guild_id INTEGER NOT NULL,
+                        day INTEGER NOT NULL,
+                        active_members INTEGER NOT NULL,
+                        events INTEGER NOT NULL,
+                        PRIMARY KEY (guild_id, day)
+                    ) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE activity_weekly (
+                        guild_id INTEGER NOT NULL,
+                        week INTEGER NOT NULL,
+                        active_members INTEGER NOT NULL,
+                        events INTEGER NOT NULL,
+                        PRIMARY KEY (guild_id, week)
+                    ) WITHOUT ROWID""")
+
+def _migrate_v9(conn):
+    """autodelete_queue.guild_id: mỗi cluster chỉ nạp lại tin của guild thuộc shard của nó."""
+    conn.execute("ALTER TABLE autodelete_queue ADD COLUMN guild_id INTEGER NOT NULL DEFAULT 0")
+
+def _migrate_v10(conn):
+    """backfill_cursors: /backfill đã đọc lùi tới tin nào ở mỗi kênh (để chạy tiếp)."""
+    conn.execute("""CREATE TABLE backfill_cursors (
+                        guild_id INTEGER NOT NULL,
+                        channel_id INTEGER NOT NULL,
+                        before_id INTEGER,
+                        done INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (guild_id, channel_id)
+                    ) WITHOUT ROWID""")
+
+def _migrate_v11(conn):
+    """autodelete_queue.token_expires: token interaction hết hạn theo lúc tạo interaction, không theo due."""
+    conn.execute("ALTER TABLE autodelete_queue ADD COLUMN token_expires REAL")
+
+def _migrate_v12(conn):
+    """backfill_cursors.since: mốc cũ nhất (epoch) mà lượt đọc kênh nhắm tới."""
+    conn.execute("ALTER TABLE backfill_cursors ADD COLUMN since INTEGER")
+
+MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5, _migrate_v6, _migrate_v7,
+              _migrate_v8, _migrate_v9, _migrate_v10, _migrate_v11, _migrate_v12]
+
+# ===== Log activity chia bảng theo ngày =====
+# Mỗi ngày (UTC) một bảng activity_YYYYMMDD(guild_id, member_id, ts), chỉ append.
+# Xóa dữ liệu cũ = DROP cả bảng, không cần DELETE từng dòng; trang trống được tái dùng.
+DAY = 86400
+ACTIVITY_PREFIX = "activity_"
+
+def activity_partition(day: int) -> str:
+    """Tên bảng log cho epoch day `day`."""
+    return ACTIVITY_PREFIX + time.strftime("%Y%m%d", time.gmtime(day * DAY))
+
+def _partition_day(name: str) -> int:
+    return int(calendar.timegm(time.strptime(name[len(ACTIVITY_PREFIX):], "%Y%m%d"))) // DAY
+
+def migrate(conn):
+    """Chạy các migration còn thiếu, mỗi migration trong một transaction riêng.
+
+    user_version được đọc sau khi đã giữ khóa ghi, nên khi nhiều process (cluster)
+    cùng mở file thì mỗi migration chỉ chạy một lần.
+    """
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.execute("COMMIT")
+                return
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        print(f"🗃️ Đã migrate database lên phiên bản {version + 1}")
+
+# ===== Snapshot (online backup) =====
+BACKUP_STEP_PAGES = 256     # số page copy mỗi bước backup
+BACKUP_STEP_SLEEP = 0.005   # nghỉ giữa các bước để nhả lock/CPU
+
+def snapshot_to(src_path, dest_path, compact=False, compress=False):
+    """Chụp DB tại một thời điểm ra `dest_path` (chạy trong worker thread).
+
+    Giữ một read transaction trên connection nguồn suốt quá trình backup: với WAL,
+    các bước backup đọc cùng một snapshot nên ghi đồng thời không làm backup restart.
+    Trả về dict thống kê: pages, bytes, elapsed, path.
+    """
+    started = time.perf_counter()
+    progress = {"pages": 0}
+
+    def _on_progress(status, remaining, total):
+        progress["pages"] = total
+
+    src = sqlite3.connect(src_path, isolation_level=None)
+    dst = sqlite3.connect(dest_path)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=BACKUP_STEP_PAGES, progress=_on_progress, sleep=BACKUP_STEP_SLEEP)
+        src.execute("COMMIT")
+    finally:
+        src.close()
+        dst.close()
+
+    result_path = dest_path
+    if compact:
+        compact_path = f"{dest_path}.compact"
+        conn = sqlite3.connect(dest_path)
+        try:
+            conn.execute("VACUUM INTO ?", (compact_path,))
+        finally:
+            conn.close()
+        os.replace(compact_path, dest_path)
+    if compress:
+        result_path = f"{dest_path}.gz"
+        with open(dest_path, "rb") as f_in, gzip.open(result_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.remove(dest_path)
+
+    return {
+        "pages": progress["pages"],
+        "bytes": os.path.getsize(result_path),
+        "elapsed": time.perf_counter() - started,
+        "path": result_path,
+    }
+
+# ===== Database =====
+def _query_name(fn) -> str:
+    """`Database.count_offline.<locals>._count` -> `count_offline`."""
+    name = fn.__qualname__.split(".<locals>")[0]
+    return name.rsplit(".", 1)[-1].lstrip("_")
+
+class Database:
+    """SQLite bất đồng bộ: 1 writer WAL + pool reader, mỗi loại có executor riêng."""
+
+    def __init__(self, path, readers: int = 3):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._reader_pool = queue.Queue()
+        # on_query(name, kind, seconds, rows): gọi từ worker thread sau mỗi truy vấn
+        self.on_query = None
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+
+    def _connect(self, readonly=False):
+        # isolation_level=None: transaction do code tự mở bằng BEGIN
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        if readonly:
+            conn.execute("PRAGMA query_only = ON")
+        else:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    # ----- vòng đời -----
+    async def open(self):
+        def _open():
+            self._writer = self._connect()
+            migrate(self._writer)
+            for _ in range(self.readers):
+                self._reader_pool.put(self._connect(readonly=True))
+        await self._run_write(_open)
+
+    async def close(self):
+        def _close_writer():
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        await self._run_write(_close_writer)
+        while not self._reader_pool.empty():
+            self._reader_pool.get_nowait().close()
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+
+    # ----- chạy hàm trên executor -----
+    async def _run_write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._write_executor, fn, *args)
+
+    async def write(self, fn, *args):
+        """Chạy fn(conn, *args) trong một transaction trên connection ghi."""
+        def _tx():
+            conn = self._writer
+            started, changes = time.perf_counter(), conn.total_changes
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if self.on_query:
+                self.on_query(_query_name(fn), "write", time.perf_counter() - started,
+                              conn.total_changes - changes)
+            return result
+        return await self._run_write(_tx)
+
+    async def read(self, fn, *args):
+        """Chạy fn(conn, *args) trên một connection đọc mượn từ pool."""
+        def _borrow():
+            conn = self._reader_pool.get()
+            started = time.perf_counter()
+            try:
+                result = fn(conn, *args)
+            finally:
+                self._reader_pool.put(conn)
+            if self.on_query:
+                rows = len(result) if isinstance(result, (list, dict)) else 1
+                self.on_query(_query_name(fn), "read", time.perf_counter() - started, rows)
+            return result
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, _borrow)
+
+    async def snapshot(self, dest_path, compact=False, compress=False) -> dict:
+        """Backup online (xem snapshot_to) trên thread riêng, không chiếm executor đọc/ghi."""
+        return await asyncio.to_thread(snapshot_to, self.path, dest_path, compact, compress)
+
+    # ===== meta =====
+    async def get_meta(self, key: str):
+        def _get(conn):
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+        return await self.read(_get)
+
+    async def set_meta(self, key: str, value: str):
+        def _set(conn):
+            conn.execute("""INSERT INTO meta (key, value) VALUES (?, ?)
+                            ON CONFLICT(key) DO UPDATE SET value = excluded.value""", (key, value))
+        await self.write(_set)
+
+    # ===== guild_settings =====
+    SETTINGS_COLUMNS = ("guild_id", "inactive_days", "role_name", "auto_delete_enabled",
+                        "auto_delete_delay", "excluded_roles", "updated_at")
+
+    async def load_guild_settings(self) -> list:
+        """Mọi dòng guild_settings dạng dict."""
+        def _load(conn):
+            cols = ", ".join(self.SETTINGS_COLUMNS)
+            return [dict(zip(self.SETTINGS_COLUMNS, row))
+                    for row in conn.execute(f"SELECT {cols} FROM guild_settings")]
+        return await self.read(_load)
+
+    async def save_guild_settings(self, rows: list):
+        """Upsert lô dict guild_settings trong một transaction."""
+        def _save(conn):
+            cols = ", ".join(self.SETTINGS_COLUMNS)
+            marks = ", ".join(f":{c}" for c in self.SETTINGS_COLUMNS)
+            updates = ", ".join(f"{c} = excluded.{c}" for c in self.SETTINGS_COLUMNS[1:])
+            conn.executemany(f"""INSERT INTO guild_settings ({cols}) VALUES ({marks})
+                                 ON CONFLICT(guild_id) DO UPDATE SET {updates}""", rows)
+        await self.write(_save)
+
+    # ===== autodelete_queue =====
+    async def load_autodelete(self) -> list:
+        """Mọi tin chờ xóa dạng (due, channel_id, message_id, token, guild_id, token_expires)."""
+        def _load(conn):
+            return conn.execute("""SELECT due, channel_id, message_id, token, guild_id, token_expires
+                                   FROM autodelete_queue""").fetchall()
+        return await self.read(_load)
+
+    async def add_autodelete(self, rows):
+        """Thêm lô (due, channel_id, message_id, token, guild_id, token_expires)."""
+        def _add(conn):
+            conn.executemany("""INSERT OR REPLACE INTO autodelete_queue
+                                    (due, channel_id, message_id, token, guild_id, token_expires)
+                                VALUES (?, ?, ?, ?, ?, ?)""", rows)
+        await self.write(_add)
+
+    async def remove_autodelete(self, keys):
+        """Xóa lô (channel_id, message_id) đã xử lý."""
+        def _remove(conn):
+            conn.executemany("DELETE FROM autodelete_queue WHERE channel_id = ? AND message_id = ?", keys)
+        await self.write(_remove)
+
+    # ===== Log activity & rollup =====
+    async def activity_partitions(self) -> list:
+        """Epoch day của mọi bảng activity_YYYYMMDD hiện có, tăng dần."""
+        def _list(conn):
+            names = conn.execute("""SELECT name FROM sqlite_master
+                                    WHERE type = 'table' AND name GLOB 'activity_[0-9]*'""").fetchall()
+            return sorted(_partition_day(name) for name, in names)
+        return await self.read(_list)
+
+    async def rollup_activity_day(self, day: int):
+        """(Tính lại) activity_daily của một ngày từ bảng log của ngày đó."""
+        def _rollup(conn):
+            conn.execute(f"""INSERT OR REPLACE INTO activity_daily (guild_id, day, active_members, events)
+                             SELECT guild_id, ?, COUNT(DISTINCT member_id), COUNT(*)
+                             FROM {activity_partition(day)} GROUP BY guild_id""", (day,))
+        await self.write(_rollup)
+
+    async def rollup_activity_week(self, week: int, days: list):
+        """(Tính lại) activity_weekly của tuần bắt đầu từ `week` từ các bảng log `days` trong tuần."""
+        def _rollup(conn):
+            union = " UNION ALL ".join(f"SELECT guild_id, member_id FROM {activity_partition(d)}" for d in days)
+            conn.execute(f"""INSERT OR REPLACE INTO activity_weekly (guild_id, week, active_members, events)
+                             SELECT guild_id, ?, COUNT(DISTINCT member_id), COUNT(*)
+                             FROM ({union}) GROUP BY guild_id""", (week,))
+        await self.write(_rollup)
+
+    async def drop_activity_partitions(self, days: list, daily_before: int):
+        """DROP bảng log của `days` và xóa activity_daily cũ hơn `daily_before`."""
+        def _drop(conn):
+            for day in days:
+                conn.execute(f"DROP TABLE IF EXISTS {activity_partition(day)}")
+            conn.execute("DELETE FROM activity_daily WHERE day < ?", (daily_before,))
+        await self.write(_drop)
+
+    async def activity_trend(self, guild_id: int, weekly: bool, since: int) -> list:
+        """[(day|week, active_members, events)] của guild từ `since` (epoch day), tăng dần."""
+        table, column = ("activity_weekly", "week") if weekly else ("activity_daily", "day")
+        def _trend(conn):
+            return conn.execute(f"""SELECT {column}, active_members, events FROM {table}
+                                    WHERE guild_id = ? AND {column} >= ? ORDER BY {column}""",
+                                (guild_id, since)).fetchall()
+        return await self.read(_trend)
+
+    # ===== backfill_cursors =====
+    async def load_backfill_cursors(self, guild_id: int) -> dict:
+        """{channel_id: (before_id, done, since)} của guild."""
+        def _load(conn):
+            return {channel_id: (before_id, bool(done), since)
+                    for channel_id, before_id, done, since in conn.execute(
+                        "SELECT channel_id, before_id, done, since FROM backfill_cursors WHERE guild_id = ?",
+                        (guild_id,))}
+        return await self.read(_load)
+
+    async def save_backfill(self, guild_id: int, channel_id: int, before_id, done: bool, since: int, seen_rows):
+        """Ghi last_seen (chỉ khi mới hơn) cùng cursor và mốc `since` của kênh trong một transaction.
+
+        done = đã đọc từ tin mới nhất lùi tới `since`.
+        """
+        def _save(conn):
+            if seen_rows:
+                self._upsert_last_seen(conn, seen_rows)
+            conn.execute("""INSERT INTO backfill_cursors (guild_id, channel_id, before_id, done, since)
+                            VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(guild_id, channel_id) DO UPDATE
+                            SET before_id = COALESCE(excluded.before_id, before_id), done = excluded.done,
+                                since = excluded.since""",
+                         (guild_id, channel_id, before_id, int(done), since))
+        await self.write(_save)
+
+    async def reset_backfill(self, guild_id: int):
+        def _reset(conn):
+            conn.execute("DELETE FROM backfill_cursors WHERE guild_id = ?", (guild_id,))
+        await self.write(_reset)
+
+    # ===== Truy vấn inactivity =====
+    @staticmethod
+    def _upsert_last_seen(conn, rows):
+        conn.executemany("""INSERT INTO inactivity (guild_id, member_id, last_seen, role_added)
+                            VALUES (?, ?, ?, NULL)
+                            ON CONFLICT(guild_id, member_id) DO UPDATE
+                            SET last_seen = excluded.last_seen
+                            WHERE excluded.last_seen > inactivity.last_seen""", rows)
+
+    @staticmethod
+    def _upsert_names(conn, rows):
+        conn.executemany("""INSERT INTO member_names (guild_id, member_id, display_name, updated_at)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT(guild_id, member_id) DO UPDATE
+                            SET display_name = excluded.display_name, updated_at = excluded.updated_at""",
+                         rows)
+
+    async def upsert_last_seen(self, rows):
+        """Ghi lô (guild_id, member_id, last_seen), chỉ ghi đè khi mới hơn."""
+        await self.write(self._upsert_last_seen, rows)
+
+    @staticmethod
+    def _append_activity(conn, rows):
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row[2] // DAY, []).append(row)
+        for day, day_rows in by_day.items():
+            table = activity_partition(day)
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                                 guild_id INTEGER NOT NULL,
+                                 member_id INTEGER NOT NULL,
+                                 ts INTEGER NOT NULL
+                             )""")
+            conn.executemany(f"INSERT INTO {table} (guild_id, member_id, ts) VALUES (?, ?, ?)", day_rows)
+
+    async def write_activity(self, seen_rows, name_rows):
+        """Ghi last_seen, log activity và tên hiển thị của một lần flush trong cùng một transaction."""
+        def _write(conn):
+            if seen_rows:
+                self._upsert_last_seen(conn, seen_rows)
+                self._append_activity(conn, seen_rows)
+            if name_rows:
+                self._upsert_names(conn, name_rows)
+        await self.write(_write)
+
+    async def get_names(self, guild_id: int, member_ids: list) -> dict:
+        """{member_id: display_name} cho các member đã từng lưu tên."""
+        def _get(conn):
+            names = {}
+            ids = list(member_ids)
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                names.update(conn.execute(
+                    f"""SELECT member_id, display_name FROM member_names
+                        WHERE guild_id = ? AND member_id IN ({marks})""", (guild_id, *chunk)))
+            return names
+        return await self.read(_get)
+
+    async def count_offline(self, guild_id: int, cutoff: int) -> int:
+        def _count(conn):
+            return conn.execute("SELECT COUNT(*) FROM inactivity WHERE guild_id = ? AND last_seen <= ?",
+                                (guild_id, cutoff)).fetchone()[0]
+        return await self.read(_count)
+
+    async def offline_page(self, guild_id: int, cutoff: int, limit: int,
+                           after: tuple = None, skip: int = 0, from_end: bool = False) -> list:
+        """Một trang (last_seen, member_id) offline, sắp theo (last_seen, member_id).
+
+        Keyset: `after` là khóa cuối của trang trước; `skip` bỏ thêm N dòng (nhảy trang);
+        `from_end` lấy `limit` dòng cuối cùng (trang cuối).
+        """
+        def _page(conn):
+            sql = "SELECT last_seen, member_id FROM inactivity WHERE guild_id = ? AND last_seen <= ?"
+            params = [guild_id, cutoff]
+            if after is not None:
+                sql += " AND (last_seen, member_id) > (?, ?)"
+                params.extend(after)
+            if from_end:
+                sql += " ORDER BY last_seen DESC, member_id DESC LIMIT ?"
+                params.append(limit)
+                return conn.execute(sql, params).fetchall()[::-1]
+            sql += " ORDER BY last_seen, member_id LIMIT ? OFFSET ?"
+            params.extend((limit, skip))
+            return conn.execute(sql, params).fetchall()
+        return await self.read(_page)
+
+    async def set_role_added(self, guild_id: int, member_ids: list, role_added):
+        """Ghi role_added (epoch hoặc None) cho một lô thành viên."""
+        def _update(conn):
+            conn.executemany("UPDATE inactivity SET role_added = ? WHERE guild_id = ? AND member_id = ?",
+                             [(role_added, guild_id, member_id) for member_id in member_ids])
+        await self.write(_update)
+
+    async def forget_members(self, guild_id: int, member_ids: list):
+        """Xóa dòng inactivity của member đã rời server (tên trong member_names vẫn giữ)."""
+        if not member_ids:
+            return
+        def _delete(conn):
+            conn.executemany("DELETE FROM inactivity WHERE guild_id = ? AND member_id = ?",
+                             [(guild_id, member_id) for member_id in member_ids])
+        await self.write(_delete)
+
+    async def iter_inactivity(self, guild_id: int = None, cutoff: int = None, chunk_size: int = 1000):
+        """Đọc (guild_id, member_id, last_seen, role_added) theo từng lô `chunk_size` dòng.
+
+        Dùng connection đọc riêng (không mượn pool) để export dài không chặn truy vấn ngắn.
+        """
+        where, params = [], []
+        if guild_id is not None:
+            where.append("guild_id = ?")
+            params.append(guild_id)
+        if cutoff is not None:
+            where.append("last_seen <= ?")
+            params.append(cutoff)
+        sql = "SELECT guild_id, member_id, last_seen, role_added FROM inactivity"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY guild_id, member_id"
+
+        loop = asyncio.get_running_loop()
+        conn = await loop.run_in_executor(self._read_executor, self._connect, True)
+        try:
+            cursor = await loop.run_in_executor(self._read_executor, conn.execute, sql, params)
+            while True:
+                rows = await loop.run_in_executor(self._read_executor, cursor.fetchmany, chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await loop.run_in_executor(self._read_executor, conn.close)
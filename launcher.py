@@ -0,0 +1,170 @@
+# ===== Sleepy Bot • Launcher nhiều cluster =====
+# Chạy sleepbot.py thành nhiều process, mỗi process (cluster) giữ một dải shard:
+#   SHARD_COUNT=16 CLUSTERS=4 python launcher.py
+# Cluster i nhận SHARD_IDS riêng, CLUSTER_ID=i và PORT = PORT + 1 + i cho health server.
+# Launcher giữ PORT gốc: /healthz và /shards gộp trạng thái của mọi cluster.
+# Cluster chết thì được khởi động lại (có backoff).
+# ============================================
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from threading import Thread
+
+from flask import Flask
+from waitress import create_server
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_SCRIPT = os.path.join(BASE_DIR, "sleepbot.py")
+BASE_PORT = int(os.getenv("PORT", 10000))
+IDENTIFY_INTERVAL = 5.5   # giây mỗi shard: Discord chỉ cho identify tuần tự (max_concurrency = 1)
+POLL_TIMEOUT = 2.0        # giây chờ health server của từng cluster
+RESTART_BACKOFF_MAX = 60  # giây
+SHUTDOWN_TIMEOUT = 30     # giây chờ cluster flush và thoát trước khi kill
+
+# Lượt identify kế tiếp được phép: dùng chung cho lần khởi động đầu và các lần restart
+identify_free_at = 0.0
+
+def reserve_identify(shard_count: int):
+    global identify_free_at
+    identify_free_at = max(identify_free_at, time.monotonic()) + shard_count * IDENTIFY_INTERVAL
+
+def recommended_shards(token: str) -> int:
+    """Số shard Discord khuyên dùng (GET /gateway/bot)."""
+    request = urllib.request.Request("https://discord.com/api/v10/gateway/bot",
+                                     headers={"Authorization": f"Bot {token}"})
+    with urllib.request.urlopen(request, timeout=10) as resp:
+        return json.load(resp)["shards"]
+
+def split_shards(shard_count: int, clusters: int) -> list:
+    """Chia shard 0..N-1 thành các dải liên tiếp; cluster 0 luôn giữ shard 0."""
+    size, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for i in range(clusters):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return [r for r in ranges if r]
+
+class Cluster:
+    def __init__(self, cluster_id: int, shard_ids: list, shard_count: int):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.port = BASE_PORT + 1 + cluster_id
+        self.process = None
+        self.started_at = 0.0
+        self.backoff = 1
+        self.restart_at = None
+
+    def start(self):
+        reserve_identify(len(self.shard_ids))
+        env = dict(os.environ,
+                   SHARD_COUNT=str(self.shard_count),
+                   SHARD_IDS=",".join(map(str, self.shard_ids)),
+                   CLUSTER_ID=str(self.cluster_id),
+                   PORT=str(self.port))
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        self.started_at = time.monotonic()
+        print(f"🚀 Cluster {self.cluster_id}: shard {self.shard_ids[0]}–{self.shard_ids[-1]}, cổng {self.port}")
+
+    def poll(self) -> dict:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/shards", timeout=POLL_TIMEOUT) as resp:
+                return json.load(resp)
+        except Exception as e:
+            return {"cluster": self.cluster_id, "ready": False, "shards": {},
+                    "problems": [f"cluster {self.cluster_id} unreachable: {e}"]}
+
+    def supervise(self):
+        """Khởi động lại process đã thoát, chờ lâu dần nếu nó chết liên tục.
+
+        Restart cũng xếp hàng identify như lúc khởi động, không chen vào cluster khác.
+        """
+        if self.process.poll() is None:
+            if time.monotonic() - self.started_at > RESTART_BACKOFF_MAX:
+                self.backoff = 1
+            return
+        if self.restart_at is None:
+            print(f"💥 Cluster {self.cluster_id} thoát với mã {self.process.returncode}, "
+                  f"chạy lại sau {self.backoff}s")
+            self.restart_at = time.monotonic() + self.backoff
+            self.backoff = min(self.backoff * 2, RESTART_BACKOFF_MAX)
+        elif time.monotonic() >= max(self.restart_at, identify_free_at):
+            self.restart_at = None
+            self.start()
+
+# ===== Health gộp =====
+app = Flask(__name__)
+clusters = []
+
+def collect() -> list:
+    return [cluster.poll() for cluster in clusters]
+
+@app.route('/')
+def home():
+    return "🟢 Skibidi Bot v6 launcher đang chạy!"
+
+@app.route('/healthz')
+def health():
+    problems = [p for state in collect() for p in state["problems"]]
+    if problems:
+        return {"status": "degraded", "problems": problems}, 503
+    return "OK"
+
+@app.route('/shards')
+def shards():
+    return {"clusters": collect()}
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def shutdown():
+    """SIGTERM cho từng cluster (bot flush rồi thoát), quá SHUTDOWN_TIMEOUT thì kill."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    running = [c for c in clusters if c.process is not None and c.process.poll() is None]
+    print(f"🛑 Đang dừng {len(running)} cluster...")
+    for cluster in running:
+        cluster.process.terminate()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for cluster in running:
+        try:
+            cluster.process.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"⚠️ Cluster {cluster.cluster_id} không tự thoát, kill.")
+            cluster.process.kill()
+            cluster.process.wait()
+
+def main():
+    token = os.getenv("TOKEN")
+    shard_count = int(os.getenv("SHARD_COUNT", 0)) or recommended_shards(token)
+    cluster_count = max(1, min(int(os.getenv("CLUSTERS", os.cpu_count() or 1)), shard_count))
+    for cluster_id, shard_ids in enumerate(split_shards(shard_count, cluster_count)):
+        clusters.append(Cluster(cluster_id, shard_ids, shard_count))
+
+    server = create_server(app, host="0.0.0.0", port=BASE_PORT)
+    Thread(target=server.run, name="health-server", daemon=True).start()
+    print(f"🌐 Launcher: {shard_count} shard / {len(clusters)} cluster, health ở cổng {BASE_PORT}")
+
+    # SIGTERM (Render redeploy) đi cùng đường với Ctrl-C: dừng mọi cluster rồi mới thoát
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    try:
+        # Khởi động lần lượt để các cluster không identify cùng lúc
+        for cluster in clusters:
+            time.sleep(max(0.0, identify_free_at - time.monotonic()))
+            cluster.start()
+        while True:
+            for cluster in clusters:
+                cluster.supervise()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        shutdown()
+
+if __name__ == "__main__":
+    main()
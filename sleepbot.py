@@ -10,22 +10,134 @@ import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 from datetime import datetime, timezone, timedelta
-import sqlite3
 import asyncio
+import contextlib
+import dataclasses
+import hashlib
 import json
+import math
 import pathlib
-from flask import Flask
+from flask import Flask, Response
 from threading import Thread
+from waitress import create_server
 import csv
+import gzip
+import io
+import itertools
+import tempfile
 import time
 import random
+import heapq
+import signal
+from collections import Counter, OrderedDict, defaultdict
+from typing import Literal
+
+import metrics
+from db import DAY, Database
 
 # ===== Đường dẫn cơ bản =====
 BASE_DIR = pathlib.Path(__file__).parent
-DB_PATH = BASE_DIR / "inactivity.db"
+DB_PATH = pathlib.Path(os.getenv("DB_PATH", BASE_DIR / "inactivity.db"))
 CONFIG_PATH = BASE_DIR / "config.json"
+DB_READERS = int(os.getenv("DB_READERS", 3))
+
+# ===== Đo thời gian khởi động =====
+STARTED_AT = time.perf_counter()
+startup_timings = {}
 
-# ===== Flask Uptime Server =====
+@contextlib.contextmanager
+def startup_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+# ===== Metrics =====
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", 2.0))      # giây
+HEALTH_MAX_DB_LATENCY = float(os.getenv("HEALTH_MAX_DB_LATENCY", 1.0))  # giây
+HEALTH_MAX_SHARD_LATENCY = float(os.getenv("HEALTH_MAX_SHARD_LATENCY", 15.0))  # giây
+WATCHDOG_INTERVAL = 0.5   # giây giữa hai lần đo lag
+DB_PROBE_EVERY = 10       # probe DB mỗi N lần đo lag
+
+registry = metrics.Registry()
+command_latency = registry.register(metrics.Histogram(
+    "sleepybot_command_seconds", "Slash command latency from interaction to completion.", ("command",)))
+command_errors = registry.register(metrics.Counter(
+    "sleepybot_command_errors_total", "Slash commands that raised.", ("command",)))
+db_query_seconds = registry.register(metrics.Histogram(
+    "sleepybot_db_query_seconds", "SQLite query time.", ("query", "kind")))
+db_query_rows = registry.register(metrics.Counter(
+    "sleepybot_db_rows_total", "Rows returned (read) or changed (write) by SQLite queries.", ("query", "kind")))
+loop_lag = registry.register(metrics.Histogram(
+    "sleepybot_loop_lag_seconds", "Event loop lag sampled by the watchdog.",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)))
+startup_phase_seconds = registry.register(metrics.Gauge(
+    "sleepybot_startup_phase_seconds", "Duration of each startup phase.", ("phase",)))
+
+shard_latency = registry.register(metrics.Gauge(
+    "sleepybot_shard_latency_seconds", "Gateway heartbeat latency per shard.", ("shard",)))
+
+health_state = {"loop_lag": 0.0, "db_latency": 0.0, "db_probe_started": None, "shards": {}}
+
+def observe_query(name: str, kind: str, seconds: float, rows: int):
+    db_query_seconds.observe(seconds, name, kind)
+    db_query_rows.inc(name, kind, amount=rows)
+
+def current_db_latency() -> float:
+    # Probe đang treo cũng tính: latency = thời gian đã chờ
+    started = health_state["db_probe_started"]
+    pending = time.monotonic() - started if started is not None else 0.0
+    return max(health_state["db_latency"], pending)
+
+async def loop_watchdog():
+    """Đo độ trễ event loop (ngủ WATCHDOG_INTERVAL, đo phần dư) và probe DB định kỳ."""
+    async def probe_db():
+        health_state["db_probe_started"] = time.monotonic()
+        try:
+            await db.get_meta("probe")
+            health_state["db_latency"] = time.monotonic() - health_state["db_probe_started"]
+        finally:
+            health_state["db_probe_started"] = None
+
+    tick, probe_task = 0, None  # giữ tham chiếu: task chỉ có weakref trong loop, có thể bị GC
+    while True:
+        expected = time.monotonic() + WATCHDOG_INTERVAL
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+        lag = max(0.0, time.monotonic() - expected)
+        health_state["loop_lag"] = lag
+        loop_lag.observe(lag)
+        health_state["shards"] = sample_shards()
+        for shard_id, info in health_state["shards"].items():
+            shard_latency.set(info["latency"], str(shard_id))
+        tick += 1
+        if tick % DB_PROBE_EVERY == 0 and (probe_task is None or probe_task.done()):
+            probe_task = asyncio.create_task(probe_db())
+
+def sample_shards() -> dict:
+    """{shard_id: {"latency", "closed"}}; bot không chia shard được coi là shard 0."""
+    shards = getattr(bot, "shards", None)
+    if shards is None:
+        return {0: {"latency": bot.latency, "closed": bot.is_closed()}}
+    return {shard_id: {"latency": info.latency, "closed": info.is_closed()}
+            for shard_id, info in shards.items()}
+
+def health_problems() -> list:
+    problems = []
+    if bot.is_ready():
+        for shard_id, info in health_state["shards"].items():
+            if info["closed"]:
+                problems.append(f"shard {shard_id} disconnected")
+            elif not info["latency"] <= HEALTH_MAX_SHARD_LATENCY:
+                problems.append(f"shard {shard_id} latency {info['latency']:.2f}s > {HEALTH_MAX_SHARD_LATENCY}s")
+    if health_state["loop_lag"] > HEALTH_MAX_LOOP_LAG:
+        problems.append(f"loop_lag {health_state['loop_lag']:.2f}s > {HEALTH_MAX_LOOP_LAG}s")
+    db_latency = current_db_latency()
+    if db_latency > HEALTH_MAX_DB_LATENCY:
+        problems.append(f"db_latency {db_latency:.2f}s > {HEALTH_MAX_DB_LATENCY}s")
+    return problems
+
+# ===== Flask Uptime Server (waitress) =====
 app = Flask(__name__)
 
 @app.route('/')
@@ -34,44 +146,244 @@ def home():
 
 @app.route('/healthz')
 def health():
+    problems = health_problems()
+    if problems:
+        return {"status": "degraded", "problems": problems}, 503
     return "OK"
 
-def run_flask():
+@app.route('/shards')
+def shards_endpoint():
+    shards = {str(shard_id): {"latency": info["latency"] if math.isfinite(info["latency"]) else None,
+                              "closed": info["closed"]}
+              for shard_id, info in health_state["shards"].items()}
+    return {"cluster": CLUSTER_ID, "ready": bot.is_ready(), "shards": shards, "problems": health_problems()}
+
+@app.route('/metrics')
+def metrics_endpoint():
+    for phase, secs in list(startup_timings.items()):
+        startup_phase_seconds.set(secs, phase)
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+def start_health_server():
+    """Bind cổng rồi mới trả về (create_server bind ngay), phục vụ trên daemon thread."""
     port = int(os.getenv("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
-
-Thread(target=run_flask).start()
-time.sleep(3)  # Đảm bảo Flask đã bind cổng trước khi bot chạy
+    with startup_phase("health_server"):
+        server = create_server(app, host="0.0.0.0", port=port)
+    Thread(target=server.run, name="health-server", daemon=True).start()
+    print(f"🌐 Health server đang nghe cổng {port}")
+    return server
 
 # ===== Cấu hình & config.json =====
+# config.json chỉ còn là giá trị mặc định ban đầu; cài đặt thật nằm trong bảng guild_settings.
 DEFAULT_CONFIG = {
     "INACTIVE_DAYS": 30,
     "AUTO_DELETE_ENABLED": True
 }
 
-CONFIG_PATH = pathlib.Path(__file__).parent / "config.json"
-
 def load_config():
     if not CONFIG_PATH.exists():
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(DEFAULT_CONFIG, f, indent=4, ensure_ascii=False)
+        save_config(DEFAULT_CONFIG)
     with open(CONFIG_PATH, "r", encoding="utf-8") as f:
         return json.load(f)
 
 def save_config(data):
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
+    # Ghi file tạm rồi rename: crash giữa chừng không làm hỏng config.json
+    tmp_path = CONFIG_PATH.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, CONFIG_PATH)
 
 config = load_config()
 
+# ===== Cấu hình theo guild =====
+HIBERNATE_ROLE_NAME = "💤 Tín Đồ Ngủ Đông"
+SETTINGS_FLUSH_DELAY = 2.0  # giây gom các lần sửa trước khi ghi DB
+
+@dataclasses.dataclass(frozen=True)
+class GuildSettings:
+    inactive_days: int = DEFAULT_CONFIG["INACTIVE_DAYS"]
+    role_name: str = HIBERNATE_ROLE_NAME
+    auto_delete_enabled: bool = DEFAULT_CONFIG["AUTO_DELETE_ENABLED"]
+    auto_delete_delay: int = 3
+    excluded_roles: tuple = ()
+
+    @classmethod
+    def from_row(cls, row: dict):
+        return cls(inactive_days=row["inactive_days"], role_name=row["role_name"],
+                   auto_delete_enabled=bool(row["auto_delete_enabled"]),
+                   auto_delete_delay=row["auto_delete_delay"],
+                   excluded_roles=tuple(json.loads(row["excluded_roles"])))
+
+    def to_row(self, guild_id: int) -> dict:
+        return {"guild_id": guild_id, "inactive_days": self.inactive_days, "role_name": self.role_name,
+                "auto_delete_enabled": int(self.auto_delete_enabled),
+                "auto_delete_delay": self.auto_delete_delay,
+                "excluded_roles": json.dumps(list(self.excluded_roles)),
+                "updated_at": to_epoch(datetime.now(timezone.utc))}
+
+class SettingsStore:
+    """Cài đặt theo guild: handler đọc từ RAM, ghi được gom lại rồi flush một transaction.
+
+    guild_id 0 giữ mặc định toàn cục (lấy từ config.json ở lần chạy đầu); guild chưa
+    chỉnh gì dùng mặc định đó.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.dirty = set()
+        self._flush_task = None
+
+    async def load(self):
+        for row in await db.load_guild_settings():
+            self.cache[row["guild_id"]] = GuildSettings.from_row(row)
+        if 0 not in self.cache:
+            defaults = GuildSettings(
+                inactive_days=config.get("INACTIVE_DAYS", DEFAULT_CONFIG["INACTIVE_DAYS"]),
+                role_name=config.get("ROLE_NAME", HIBERNATE_ROLE_NAME),
+                auto_delete_enabled=config.get("AUTO_DELETE_ENABLED", DEFAULT_CONFIG["AUTO_DELETE_ENABLED"]),
+                auto_delete_delay=config.get("AUTO_DELETE_DELAY", 3),
+            )
+            self.cache[0] = defaults
+            await db.save_guild_settings([defaults.to_row(0)])
+            print("⚙️ Đã chuyển config.json thành cài đặt mặc định trong DB.")
+
+    def get(self, guild_id: int) -> GuildSettings:
+        return self.cache.get(guild_id) or self.cache.get(0) or GuildSettings()
+
+    def update(self, guild_id: int, **changes) -> GuildSettings:
+        updated = dataclasses.replace(self.get(guild_id), **changes)
+        self.cache[guild_id] = updated
+        self.dirty.add(guild_id)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._debounced_flush())
+        return updated
+
+    async def _debounced_flush(self):
+        await asyncio.sleep(SETTINGS_FLUSH_DELAY)
+        await self.flush()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        try:
+            await db.save_guild_settings([self.cache[g].to_row(g) for g in dirty])
+        except Exception as e:
+            print(f"⚠️ Lỗi lưu cài đặt guild: {e}")
+            self.dirty |= dirty
+
+settings = SettingsStore()
+
+def inactive_cutoff(guild_id: int, now: int = None) -> int:
+    now = now if now is not None else to_epoch(datetime.now(timezone.utc))
+    return now - settings.get(guild_id).inactive_days * DAY
+
+# ===== Sharding =====
+# SHARD_COUNT (hoặc SHARDED=1 để Discord tự chọn số shard) -> AutoShardedBot.
+# launcher.py chạy nhiều cluster, mỗi cluster nhận SHARD_IDS riêng; mọi cluster
+# dùng chung inactivity.db (WAL), mỗi process tự gom lô ghi qua ActivityTracker.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0)) or None
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()] or None
+CLUSTER_ID = int(os.getenv("CLUSTER_ID", 0))
+SHARDED = bool(SHARD_COUNT or os.getenv("SHARDED") == "1")
+IS_PRIMARY_CLUSTER = CLUSTER_ID == 0  # cluster 0 lo việc dùng chung: sync command, rollup activity
+
+def owns_guild(guild_id: int) -> bool:
+    """Guild có thuộc các shard của process này không (luôn đúng khi không chia cluster)."""
+    if not (SHARD_IDS and SHARD_COUNT):
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+# ===== Chế độ member lười (LAZY_MEMBERS=1) =====
+# Không chunk member lúc kết nối: cache chỉ giữ member đang ở voice, mới vào server hoặc
+# vừa được lấy theo yêu cầu (MemberFetcher). Activity presence đọc từ event raw,
+# số người ngủ đông đếm từ role_added trong DB thay vì role.members.
+LAZY_MEMBERS = os.getenv("LAZY_MEMBERS") == "1"
+QUERY_MEMBERS_BATCH = 100  # giới hạn user_ids của một request query_members
+
 # ===== Discord Bot =====
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="!", intents=intents)
+
+class SleepyBot(commands.AutoShardedBot if SHARDED else commands.Bot):
+    shutdown_started = False
+    shutdown_task = None
+    watchdog_task = None
+
+    async def setup_hook(self):
+        # Render (redeploy) và launcher.py dừng process bằng SIGTERM: đóng bot như Ctrl-C để flush
+        with contextlib.suppress(NotImplementedError):  # Windows không có add_signal_handler
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.request_shutdown)
+        db.on_query = observe_query
+        with startup_phase("db_open"):
+            await db.open()
+            await settings.load()
+        # Sau db.open: probe DB đầu tiên không được chạy trước khi có kết nối
+        self.watchdog_task = asyncio.create_task(loop_watchdog())
+        with startup_phase("state_rebuild"):
+            await rebuild_state_from_db()
+            await autodelete.load()
+        tracker.start()
+        autodelete.start()
+        if IS_PRIMARY_CLUSTER:
+            with startup_phase("command_sync"):
+                await sync_commands_if_changed()
+
+    def request_shutdown(self):
+        if self.shutdown_task is None:
+            self.shutdown_task = asyncio.create_task(self.close())
+
+    async def start(self, *args, **kwargs):
+        try:
+            await super().start(*args, **kwargs)
+        finally:
+            # Sau SIGTERM, start() trả về ngay khi gateway đóng; chờ close() flush xong
+            # trước khi asyncio.run hủy các task còn lại
+            if self.shutdown_task is not None:
+                await self.shutdown_task
+
+    async def stop_background_work(self):
+        """Dừng mọi vòng lặp và /backfill đang chạy để không còn gì gọi Discord hay ghi DB."""
+        loops = (role_sweep, activity_compactor, change_status)
+        pending = [self.watchdog_task, *(loop.get_task() for loop in loops), *backfill_runs]
+        pending = [task for task in pending if task is not None]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await autodelete.close()
+
+    async def close(self):
+        # Có thể bị gọi lại khi run() kết thúc sau SIGTERM: chỉ flush và đóng DB một lần
+        first = not self.shutdown_started
+        self.shutdown_started = True
+        if first:
+            await self.stop_background_work()
+        await super().close()
+        if first:
+            # Gateway đã đóng nên không còn activity mới: flush phần còn trong RAM rồi đóng DB
+            await tracker.close()
+            await settings.flush()
+            await db.close()
+
+shard_options = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS} if SHARDED else {}
+member_options = {
+    "chunk_guilds_at_startup": False,
+    "member_cache_flags": discord.MemberCacheFlags(voice=True, joined=True),
+    "enable_raw_presences": True,
+} if LAZY_MEMBERS else {}
+bot = SleepyBot(command_prefix="!", intents=intents, **shard_options, **member_options)
 tree = bot.tree
 
 # ===== Biến toàn cục =====
 last_command_msg_id = {}
-delete_timers = {}
+
+registry.register(metrics.Gauge(
+    "sleepybot_gateway_latency_seconds", "Discord gateway heartbeat latency.", fn=lambda: bot.latency))
+registry.register(metrics.Gauge(
+    "sleepybot_delete_timers", "Messages waiting in the auto-delete queue.", fn=lambda: len(autodelete.heap)))
+registry.register(metrics.Gauge(
+    "sleepybot_last_command_msg_ids", "Entries in last_command_msg_id.", fn=lambda: len(last_command_msg_id)))
 
 # ===== Hàm tiện ích =====
 def make_embed(title="", desc="", color=discord.Color.purple()):
@@ -79,44 +391,686 @@ def make_embed(title="", desc="", color=discord.Color.purple()):
     embed.timestamp = datetime.now(timezone.utc)
     return embed
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS inactivity (
-                    member_id TEXT,
-                    guild_id TEXT,
-                    last_seen TEXT,
-                    role_added TEXT
-                )""")
-    conn.commit()
-    return conn
-
-# ===== schedule_autodelete =====
-async def schedule_autodelete(channel_id: int, msg_id: int):
-    """Tự động xóa tin nhắn cũ nếu bật AUTO_DELETE_ENABLED."""
-    if not config.get("AUTO_DELETE_ENABLED", True):
-        return
-    if channel_id in delete_timers:
-        delete_timers[channel_id].cancel()
-
-    async def delayed_delete():
-        await asyncio.sleep(3)
+def to_epoch(dt: datetime) -> int:
+    return int(dt.timestamp())
+
+def from_epoch(ts) -> datetime:
+    return datetime.fromtimestamp(ts, timezone.utc) if ts is not None else None
+
+# ===== Activity tracker (write-behind) =====
+TRACKER_FLUSH_INTERVAL = float(os.getenv("TRACKER_FLUSH_INTERVAL", 10))  # giây
+TRACKER_FLUSH_MAX = int(os.getenv("TRACKER_FLUSH_MAX", 1000))  # số entry
+
+class ActivityTracker:
+    """Gom last_seen mới nhất theo (guild, member) trong RAM rồi flush theo lô.
+
+    Mỗi event chỉ cập nhật dict; việc ghi SQLite chạy trong thread riêng,
+    mỗi `flush_interval` giây hoặc khi số entry chờ đạt `max_pending`.
+    """
+
+    def __init__(self, flush_interval=TRACKER_FLUSH_INTERVAL, max_pending=TRACKER_FLUSH_MAX):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.names = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def touch(self, guild_id: int, member_id: int, when: int):
+        key = (guild_id, member_id)
+        current = self.pending.get(key)
+        if current is None or when > current:
+            self.pending[key] = when
+        if len(self.pending) >= self.max_pending:
+            self._wakeup.set()
+
+    def touch_name(self, guild_id: int, member_id: int, name: str, when: int):
+        self.names[(guild_id, member_id)] = (name, when)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending and not self.names:
+                return 0
+            batch, self.pending = self.pending, {}
+            names, self.names = self.names, {}
+            rows = [(guild_id, member_id, seen)
+                    for (guild_id, member_id), seen in batch.items()]
+            name_rows = [(guild_id, member_id, name, when)
+                         for (guild_id, member_id), (name, when) in names.items()]
+            try:
+                await db.write_activity(rows, name_rows)
+            except Exception as e:
+                print(f"⚠️ Lỗi flush activity ({len(rows)} dòng): {e}")
+                # Trả lô lại để lần flush sau ghi tiếp, không đè giá trị mới hơn
+                for key, seen in batch.items():
+                    current = self.pending.get(key)
+                    if current is None or seen > current:
+                        self.pending[key] = seen
+                for key, value in names.items():
+                    self.names.setdefault(key, value)
+                return 0
+            return len(rows) + len(name_rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        written = await self.flush()
+        print(f"💾 Activity tracker đã flush {written} dòng trước khi tắt.")
+
+db = Database(DB_PATH, readers=DB_READERS)
+tracker = ActivityTracker()
+
+# ===== Cache tên thành viên =====
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", 50000))
+
+class NameCache:
+    """Tên hiển thị theo (guild, member): LRU trong RAM, bảng member_names phía sau.
+
+    Tên mới được ghi write-behind cùng lần flush của tracker. Người đã rời server
+    vẫn giữ tên cuối cùng, và không cần member cache đầy đủ của discord.py.
+    """
+
+    def __init__(self, capacity: int = NAME_CACHE_SIZE):
+        self.capacity = capacity
+        self.lru = OrderedDict()
+
+    def _put(self, key, name: str):
+        self.lru[key] = name
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    def remember(self, member: discord.Member):
+        key = (member.guild.id, member.id)
+        name = member.display_name
+        if self.lru.get(key) == name:
+            self.lru.move_to_end(key)
+            return
+        self._put(key, name)
+        tracker.touch_name(member.guild.id, member.id, name, to_epoch(datetime.now(timezone.utc)))
+
+    async def resolve(self, guild_id: int, member_ids: list, fetch_missing: bool = False) -> dict:
+        """{member_id: tên} cho cả lô: member cache -> LRU -> một truy vấn DB.
+
+        `fetch_missing` (chỉ có tác dụng ở LAZY_MEMBERS): ai vẫn chưa có tên thì hỏi gateway.
+        """
+        guild = bot.get_guild(guild_id)
+        names, missing = {}, []
+        for member_id in member_ids:
+            member = guild.get_member(member_id) if guild else None
+            if member:
+                names[member_id] = member.display_name
+                continue
+            key = (guild_id, member_id)
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                names[member_id] = self.lru[key]
+            else:
+                missing.append(member_id)
+        if missing:
+            found = await db.get_names(guild_id, missing)
+            for member_id, name in found.items():
+                self._put((guild_id, member_id), name)
+            names.update(found)
+            unresolved = [m for m in missing if m not in found]
+            if fetch_missing and LAZY_MEMBERS and guild and unresolved:
+                for member_id, member in (await member_fetcher.fetch(guild, unresolved)).items():
+                    self.remember(member)
+                    names[member_id] = member.display_name
+        return names
+
+name_cache = NameCache()
+
+class MemberFetcher:
+    """Lấy member chưa có trong cache qua query_members, theo lô tối đa QUERY_MEMBERS_BATCH id.
+
+    Các yêu cầu đồng thời cho cùng một guild được gom vào cùng một hàng chờ,
+    một task mỗi guild rút hàng chờ đó; id đang chờ thì không hỏi lại lần hai.
+    """
+
+    def __init__(self):
+        self.pending = defaultdict(dict)  # guild_id -> {member_id: Future[Member | None]}
+        self._tasks = {}
+
+    async def fetch(self, guild: discord.Guild, member_ids: list) -> dict:
+        """{member_id: Member} cho những id còn ở trong server."""
+        found, waiting = {}, {}
+        loop = asyncio.get_running_loop()
+        pending = self.pending[guild.id]
+        for member_id in member_ids:
+            member = guild.get_member(member_id)
+            if member:
+                found[member_id] = member
+                continue
+            future = pending.get(member_id)
+            if future is None:
+                future = pending[member_id] = loop.create_future()
+            waiting[member_id] = future
+        if waiting and guild.id not in self._tasks:
+            self._tasks[guild.id] = asyncio.create_task(self._drain(guild))
+        for member_id, future in waiting.items():
+            member = await future
+            if member:
+                found[member_id] = member
+        return found
+
+    async def _drain(self, guild: discord.Guild):
+        pending = self.pending[guild.id]
         try:
-            channel = bot.get_channel(channel_id)
-            if not channel:
+            await asyncio.sleep(0)  # để các yêu cầu cùng lượt loop kịp vào hàng chờ
+            while pending:
+                batch = dict(itertools.islice(pending.items(), QUERY_MEMBERS_BATCH))
+                for member_id in batch:
+                    del pending[member_id]
+                try:
+                    members = await guild.query_members(user_ids=list(batch), limit=len(batch), cache=True)
+                except Exception as e:
+                    print(f"⚠️ Lỗi query_members ở {guild.name}: {e}")
+                    members = []
+                by_id = {member.id: member for member in members}
+                for member_id, future in batch.items():
+                    if not future.done():
+                        future.set_result(by_id.get(member_id))
+        finally:
+            self._tasks.pop(guild.id, None)
+
+member_fetcher = MemberFetcher()
+
+# ===== Thống kê inactivity theo guild =====
+STAT_BUCKETS = [1, 7, 14, 30, 60, 90]  # ngưỡng ngày; bucket cuối là 90+
+
+def today_epoch_day() -> int:
+    return to_epoch(datetime.now(timezone.utc)) // DAY
+
+class GuildStats:
+    """Histogram thành viên theo ngày last_seen + số người đang có role ngủ đông.
+
+    `per_day` đếm theo ngày (epoch day) trong cửa sổ STAT_BUCKETS[-1] ngày gần nhất;
+    ngày cũ hơn được gộp vào `older`, nên mỗi truy vấn chỉ cộng tối đa ~90 ô.
+    """
+
+    def __init__(self):
+        self.last_seen = {}
+        self.per_day = Counter()
+        self.older = 0
+        self.horizon = today_epoch_day() - STAT_BUCKETS[-1] + 1
+        self.hibernating = 0
+
+    def _roll(self, today: int):
+        horizon = today - STAT_BUCKETS[-1] + 1
+        if horizon <= self.horizon:
+            return
+        for day in [d for d in self.per_day if d < horizon]:
+            self.older += self.per_day.pop(day)
+        self.horizon = horizon
+
+    def _add(self, day: int, delta: int):
+        if day < self.horizon:
+            self.older += delta
+            return
+        self.per_day[day] += delta
+        if not self.per_day[day]:
+            del self.per_day[day]
+
+    def seen(self, member_id: int, ts: int):
+        old = self.last_seen.get(member_id)
+        if old is not None:
+            if old >= ts:
                 return
-            msg = await channel.fetch_message(msg_id)
-            await msg.delete()
-            print(f"🗑️ Đã xóa embed cũ ở #{channel.name}")
-        except discord.NotFound:
-            pass
+            self._add(old // DAY, -1)
+        self.last_seen[member_id] = ts
+        self._add(ts // DAY, 1)
+
+    def forget(self, member_id: int):
+        old = self.last_seen.pop(member_id, None)
+        if old is not None:
+            self._add(old // DAY, -1)
+
+    def offline_at_least(self, days: int) -> int:
+        """Số thành viên có last_seen cách hôm nay ≥ `days` ngày (theo ngày UTC).
+
+        `days` lớn hơn bucket cuối được tính như bucket cuối (90+).
+        """
+        today = today_epoch_day()
+        self._roll(today)
+        if days >= STAT_BUCKETS[-1]:
+            return self.older
+        return self.older + sum(n for day, n in self.per_day.items() if today - day >= days)
+
+    def histogram(self) -> list:
+        """[(nhãn, số lượng)] theo STAT_BUCKETS, từ mới đến cũ."""
+        total = len(self.last_seen)
+        at_least = [total] + [self.offline_at_least(d) for d in STAT_BUCKETS]
+        labels = [f"< {STAT_BUCKETS[0]} ngày"]
+        labels += [f"{lo}–{hi - 1} ngày" for lo, hi in zip(STAT_BUCKETS, STAT_BUCKETS[1:])]
+        labels.append(f"≥ {STAT_BUCKETS[-1]} ngày")
+        counts = [a - b for a, b in zip(at_least, at_least[1:])] + [at_least[-1]]
+        return list(zip(labels, counts))
+
+guild_stats = defaultdict(GuildStats)
+
+def record_activity(guild_id: int, member_id: int, when: datetime = None):
+    ts = to_epoch(when or datetime.now(timezone.utc))
+    tracker.touch(guild_id, member_id, ts)
+    merge_seen(guild_id, member_id, ts)
+
+def merge_seen(guild_id: int, member_id: int, ts: int):
+    """Cập nhật histogram và hàng đợi hết hạn; bỏ qua nếu ts không mới hơn giá trị đang có."""
+    stats = guild_stats[guild_id]
+    current = stats.last_seen.get(member_id)
+    if current is not None and current >= ts:
+        return
+    stats.seen(member_id, ts)
+    expiry.seen(guild_id, member_id, ts, current is None)
+
+async def rebuild_state_from_db():
+    """Nạp histogram và hàng đợi hết hạn từ DB, chỉ chạy một lần lúc khởi động."""
+    rows_total = 0
+    cutoffs = {}
+    async for rows in db.iter_inactivity(chunk_size=5000):
+        for guild_id, member_id, last_seen, role_added in rows:
+            if not owns_guild(guild_id):
+                continue
+            if guild_id not in cutoffs:
+                cutoffs[guild_id] = inactive_cutoff(guild_id)
+            guild_stats[guild_id].seen(member_id, last_seen)
+            expiry.load(guild_id, member_id, last_seen, role_added is not None, cutoffs[guild_id])
+        rows_total += len(rows)
+    expiry.heapify()
+    print(f"📊 Đã nạp thống kê inactivity từ {rows_total} dòng DB.")
+
+def count_hibernating(guild: discord.Guild):
+    if LAZY_MEMBERS:
+        # role.members chỉ thấy member đang cache; dùng role_added đã nạp từ DB
+        guild_stats[guild.id].hibernating = len(expiry.flagged[guild.id])
+        return
+    role = discord.utils.get(guild.roles, name=settings.get(guild.id).role_name)
+    guild_stats[guild.id].hibernating = len(role.members) if role else 0
+
+def hibernating_count(guild_id: int) -> int:
+    if LAZY_MEMBERS:
+        return len(expiry.flagged[guild_id])
+    return guild_stats[guild_id].hibernating
+
+# ===== Gán role ngủ đông hàng loạt =====
+ROLE_SWEEP_MINUTES = float(os.getenv("ROLE_SWEEP_MINUTES", 5))
+ROLE_SWEEP_BATCH = int(os.getenv("ROLE_SWEEP_BATCH", 100))
+ROLE_WORKERS = int(os.getenv("ROLE_WORKERS", 4))      # số guild xử lý song song
+ROLE_RATE = float(os.getenv("ROLE_RATE", 10))         # request role / giây, toàn bot
+
+class RolePacer:
+    """Giãn đều request role ở mức `rate`/giây cho toàn bot (dưới global limit 50/s)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+role_pacer = RolePacer(ROLE_RATE)
+sweep_locks = defaultdict(asyncio.Lock)
+# Guild bị 403 khi gán role: bỏ qua ở sweep cho tới khi role đổi hoặc admin chạy /runcheck
+role_blocked = set()
+
+UNKNOWN_MEMBER_CODES = (10007, 10013)  # Unknown Member / Unknown User
+
+async def apply_role(guild_id: int, role_id: int, member_ids: list, add: bool):
+    """Thêm/gỡ role cho từng member, tuần tự trong guild (cùng một rate-limit bucket).
+
+    Trả về (done, departed, error): `done` đã thêm/gỡ xong, `departed` đã rời server.
+    Lỗi khác (thiếu quyền, role bị xóa, HTTP 5xx...) dừng lô và được trả về trong `error`;
+    hai list luôn là phần đầu của `member_ids` đã xử lý, phần còn lại chưa đụng tới.
+    """
+    done, departed = [], []
+    reason = "Sleepy Bot: inactivity sweep"
+    for member_id in member_ids:
+        await role_pacer.wait()
+        try:
+            if add:
+                await bot.http.add_role(guild_id, member_id, role_id, reason=reason)
+            else:
+                await bot.http.remove_role(guild_id, member_id, role_id, reason=reason)
+        except discord.NotFound as e:
+            if e.code not in UNKNOWN_MEMBER_CODES:
+                return done, departed, e
+            departed.append(member_id)
+            continue
         except Exception as e:
-            print(f"⚠️ Lỗi xóa embed: {e}")
-        finally:
-            delete_timers.pop(channel_id, None)
+            return done, departed, e
+        done.append(member_id)
+    return done, departed, None
+
+class ExpiryQueue:
+    """Min-heap (last_seen, member_id) theo guild cho thành viên chưa có role ngủ đông.
+
+    Activity không đụng tới heap: entry chỉ được đổi khóa khi bị pop, nếu last_seen
+    hiện tại (guild_stats) mới hơn thì đẩy lại với khóa mới. Mỗi tick chỉ pop các entry
+    có last_seen <= cutoff nên chi phí tỉ lệ với số thay đổi, không với số thành viên.
+    """
+
+    def __init__(self):
+        self.heaps = defaultdict(list)
+        self.flagged = defaultdict(set)     # đang có role (role_added khác NULL)
+        self.returning = defaultdict(set)   # có role nhưng đã hoạt động lại
+
+    def load(self, guild_id: int, member_id: int, last_seen: int, has_role: bool, cutoff: int):
+        if has_role:
+            self.flagged[guild_id].add(member_id)
+            if last_seen > cutoff:
+                self.returning[guild_id].add(member_id)
+        else:
+            self.heaps[guild_id].append((last_seen, member_id))
+
+    def heapify(self):
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+
+    def seen(self, guild_id: int, member_id: int, ts: int, is_new: bool):
+        if member_id in self.flagged[guild_id]:
+            if ts > inactive_cutoff(guild_id):
+                self.returning[guild_id].add(member_id)
+        elif is_new:
+            heapq.heappush(self.heaps[guild_id], (ts, member_id))
+
+    def pop_expired(self, guild_id: int, cutoff: int):
+        """Trả về (member_id hết hạn, số entry đã pop)."""
+        heap = self.heaps[guild_id]
+        last_seen = guild_stats[guild_id].last_seen
+        flagged = self.flagged[guild_id]
+        expired, processed = [], 0
+        while heap and heap[0][0] <= cutoff:
+            ts, member_id = heapq.heappop(heap)
+            processed += 1
+            if member_id in flagged or member_id not in last_seen:
+                continue
+            current = last_seen[member_id]
+            if current > cutoff:
+                heapq.heappush(heap, (current, member_id))
+                continue
+            expired.append(member_id)
+        return expired, processed
+
+    def mark_flagged(self, guild_id: int, member_ids: list):
+        self.flagged[guild_id].update(member_ids)
+
+    def mark_returned(self, guild_id: int, member_ids: list):
+        flagged = self.flagged[guild_id]
+        last_seen = guild_stats[guild_id].last_seen
+        for member_id in member_ids:
+            flagged.discard(member_id)
+            if member_id in last_seen:
+                heapq.heappush(self.heaps[guild_id], (last_seen[member_id], member_id))
+
+    def requeue(self, guild_id: int, expired: list, returning: list):
+        """Trả lại phần chưa xử lý khi lượt của guild bị dừng giữa chừng."""
+        last_seen = guild_stats[guild_id].last_seen
+        for member_id in expired:
+            heapq.heappush(self.heaps[guild_id], (last_seen.get(member_id, 0), member_id))
+        self.returning[guild_id].update(returning)
+
+    def forget(self, guild_id: int, member_ids: list):
+        """Member đã rời server: bỏ khỏi mọi trạng thái (entry trong heap tự bị bỏ khi pop)."""
+        for member_id in member_ids:
+            self.flagged[guild_id].discard(member_id)
+            self.returning[guild_id].discard(member_id)
+            guild_stats[guild_id].forget(member_id)
+
+    def defer(self, guild_id: int, member_id: int, until: int):
+        """Hoãn xét lại member tới khi `until` cũng hết hạn (vd. đang có role được miễn)."""
+        heapq.heappush(self.heaps[guild_id], (until, member_id))
+
+    def recheck_flagged(self, guild_id: int, cutoff: int):
+        """Sau khi đổi số ngày inactive: người có role nhưng giờ chưa đủ ngày -> gỡ role."""
+        last_seen = guild_stats[guild_id].last_seen
+        self.returning[guild_id].update(m for m in self.flagged[guild_id] if last_seen.get(m, 0) > cutoff)
+
+expiry = ExpiryQueue()
+
+async def check_guild(guild: discord.Guild, force: bool = False) -> dict:
+    """Một tick: gán role cho entry đã hết hạn, gỡ role cho người quay lại.
+
+    role_added được ghi DB sau mỗi lô; nếu bot tắt giữa chừng, hàng đợi dựng lại từ DB
+    lúc khởi động sẽ chứa đúng phần chưa xử lý. Guild trong role_blocked chỉ được
+    xét lại khi `force` (/runcheck).
+    """
+    result = {"processed": 0, "added": 0, "removed": 0}
+    if force:
+        role_blocked.discard(guild.id)
+    elif guild.id in role_blocked:
+        return result
+    guild_settings = settings.get(guild.id)
+    role = discord.utils.get(guild.roles, name=guild_settings.role_name)
+    if not role:
+        return result
+    async with sweep_locks[guild.id]:
+        now = to_epoch(datetime.now(timezone.utc))
+        expired, result["processed"] = expiry.pop_expired(guild.id, inactive_cutoff(guild.id, now))
+        if guild_settings.excluded_roles:
+            excluded = set(guild_settings.excluded_roles)
+            if LAZY_MEMBERS:
+                members = await member_fetcher.fetch(guild, expired)
+            else:
+                members = {m: member for m in expired if (member := guild.get_member(m))}
+            kept = []
+            for member_id in expired:
+                member = members.get(member_id)
+                if member and any(r.id in excluded for r in member.roles):
+                    expiry.defer(guild.id, member_id, now)
+                else:
+                    kept.append(member_id)
+            expired = kept
+        returning = list(expiry.returning.pop(guild.id, ()))
+        result["processed"] += len(returning)
+        # Lỗi ở bất kỳ bước nào: phần đã xử lý được ghi nhận (RAM trước, DB sau),
+        # phần chưa xử lý trả lại hàng đợi cho tick sau.
+        try:
+            while expired:
+                done, departed, error = await apply_role(guild.id, role.id, expired[:ROLE_SWEEP_BATCH], add=True)
+                expired = expired[len(done) + len(departed):]
+                expiry.mark_flagged(guild.id, done)
+                expiry.forget(guild.id, departed)
+                result["added"] += len(done)
+                await db.set_role_added(guild.id, done, now)
+                await db.forget_members(guild.id, departed)
+                if error:
+                    raise error
+            while returning:
+                done, departed, error = await apply_role(guild.id, role.id, returning[:ROLE_SWEEP_BATCH], add=False)
+                returning = returning[len(done) + len(departed):]
+                expiry.mark_returned(guild.id, done)
+                expiry.forget(guild.id, departed)
+                result["removed"] += len(done)
+                await db.set_role_added(guild.id, done, None)
+                await db.forget_members(guild.id, departed)
+                if error:
+                    raise error
+        except Exception as e:
+            if isinstance(e, discord.Forbidden):
+                role_blocked.add(guild.id)
+                print(f"⚠️ Thiếu quyền Manage Roles ở {guild.name}, tạm dừng gán role "
+                      f"tới khi role thay đổi hoặc /runcheck.")
+            else:
+                print(f"⚠️ Lỗi gán role ở {guild.name}, thử lại ở tick sau: {e}")
+            expiry.requeue(guild.id, expired, returning)
+            return result
+    if result["added"] or result["removed"]:
+        print(f"💤 Check {guild.name}: +{result['added']} / -{result['removed']} role.")
+    return result
+
+async def check_all_guilds():
+    """Đưa mọi guild vào queue, ROLE_WORKERS worker xử lý, mỗi guild một worker."""
+    queue = asyncio.Queue()
+    for guild in bot.guilds:
+        queue.put_nowait(guild)
+
+    async def worker():
+        while not queue.empty():
+            guild = queue.get_nowait()
+            try:
+                await check_guild(guild)
+            except Exception as e:
+                print(f"⚠️ Lỗi kiểm tra {guild.name}: {e}")
 
-    task = asyncio.create_task(delayed_delete())
-    delete_timers[channel_id] = task
+    await asyncio.gather(*(worker() for _ in range(min(ROLE_WORKERS, queue.qsize()))))
+
+# ===== schedule_autodelete =====
+AUTODELETE_COALESCE = 1.0   # giây: gom các tin gần hạn để bulk delete một lần
+AUTODELETE_BULK_MAX = 100   # giới hạn của API bulk delete
+WEBHOOK_TOKEN_TTL = 15 * 60  # token interaction hết hạn 15 phút sau khi interaction được tạo
+WEBHOOK_TOKEN_MARGIN = 10    # giây: xóa tin ephemeral sớm hơn hạn token một chút
+
+class AutoDeleteScheduler:
+    """Một task duy nhất xóa tin theo heap (due, channel_id, message_id, token).
+
+    Tin thường xóa qua PartialMessage (không fetch), nhiều tin cùng kênh thì bulk delete;
+    tin ephemeral (có token) xóa qua webhook của interaction. Hàng đợi được lưu trong DB
+    để không mất lịch xóa khi redeploy.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def load(self):
+        now = time.time()
+        stale = []
+        for due, channel_id, message_id, token, guild_id, token_expires in await db.load_autodelete():
+            if not owns_guild(guild_id):
+                continue
+            # Dòng cũ chưa có token_expires: ước lượng theo due như trước
+            if token_expires is None:
+                token_expires = due + WEBHOOK_TOKEN_TTL
+            if token and token_expires <= max(now, due):
+                stale.append((channel_id, message_id))
+                continue
+            self.heap.append((due, channel_id, message_id, token))
+        heapq.heapify(self.heap)
+        if stale:
+            await db.remove_autodelete(stale)
+
+    async def schedule(self, guild_id: int, channel_id: int, message_id: int, delay: float,
+                       token: str = None, token_expires: float = None):
+        entry = (time.time() + delay, channel_id, message_id, token)
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self._wakeup.set()
+        await db.add_autodelete([(*entry, guild_id, token_expires)])
+
+    def _pop_due(self):
+        horizon = time.time() + AUTODELETE_COALESCE
+        due = []
+        while self.heap and self.heap[0][0] <= horizon:
+            due.append(heapq.heappop(self.heap))
+        return due
+
+    async def _delete_channel_messages(self, channel_id: int, message_ids: list):
+        if len(message_ids) == 1:
+            await bot.get_partial_messageable(channel_id).get_partial_message(message_ids[0]).delete()
+            return
+        for i in range(0, len(message_ids), AUTODELETE_BULK_MAX):
+            chunk = message_ids[i:i + AUTODELETE_BULK_MAX]
+            try:
+                await bot.http.delete_messages(channel_id, chunk)
+            except discord.HTTPException:
+                # Bulk delete từ chối tin > 14 ngày hoặc id đã mất: xóa lẻ từng tin
+                for message_id in chunk:
+                    with contextlib.suppress(discord.NotFound):
+                        await bot.get_partial_messageable(channel_id).get_partial_message(message_id).delete()
+
+    async def _process(self, entries):
+        by_channel = defaultdict(list)
+        for _, channel_id, message_id, token in entries:
+            try:
+                if token:
+                    webhook = discord.Webhook.partial(bot.application_id, token, client=bot)
+                    await webhook.delete_message(message_id)
+                else:
+                    by_channel[channel_id].append(message_id)
+            except discord.NotFound:
+                pass
+            except Exception as e:
+                print(f"⚠️ Lỗi xóa embed ephemeral: {e}")
+        for channel_id, message_ids in by_channel.items():
+            try:
+                await self._delete_channel_messages(channel_id, message_ids)
+                print(f"🗑️ Đã xóa {len(message_ids)} embed cũ ở kênh {channel_id}")
+            except discord.NotFound:
+                pass
+            except Exception as e:
+                print(f"⚠️ Lỗi xóa embed: {e}")
+        await db.remove_autodelete([(channel_id, message_id) for _, channel_id, message_id, _ in entries])
+
+    async def _run(self):
+        while True:
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            due = self._pop_due()
+            try:
+                await self._process(due)
+            except Exception as e:
+                print(f"⚠️ Lỗi auto-delete: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Hàng đợi đã nằm trong DB, chỉ cần dừng task
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+autodelete = AutoDeleteScheduler()
+
+async def schedule_autodelete(interaction: discord.Interaction, message: discord.Message, delay: float = None):
+    """Hẹn xóa tin bot vừa gửi nếu guild bật auto-delete (`delay` mặc định theo cài đặt guild)."""
+    guild_settings = settings.get(interaction.guild_id or 0)
+    if not guild_settings.auto_delete_enabled:
+        return
+    token = interaction.token if message.flags.ephemeral else None
+    delay = delay if delay is not None else guild_settings.auto_delete_delay
+    token_expires = None
+    if token:
+        # Tin ephemeral chỉ xóa được khi token còn sống: không hẹn quá hạn token
+        token_expires = interaction.created_at.timestamp() + WEBHOOK_TOKEN_TTL
+        delay = max(0.0, min(delay, token_expires - WEBHOOK_TOKEN_MARGIN - time.time()))
+    await autodelete.schedule(interaction.guild_id or 0, interaction.channel_id, message.id, delay,
+                              token, token_expires)
 
 # ===== /setinactive =====
 @tree.command(name="setinactive", description="Chỉnh số ngày inactive để kiểm tra.")
@@ -125,8 +1079,8 @@ async def setinactive(interaction: discord.Interaction, days: int):
     if days < 1:
         await interaction.response.send_message("❌ Số ngày phải ≥ 1.", ephemeral=True)
         return
-    config["INACTIVE_DAYS"] = days
-    save_config(config)
+    settings.update(interaction.guild_id, inactive_days=days)
+    expiry.recheck_flagged(interaction.guild_id, inactive_cutoff(interaction.guild_id))
     embed = make_embed("✅ Cập nhật thành công", f"Số ngày inactive được đặt là **{days} ngày**.")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
@@ -134,72 +1088,254 @@ async def setinactive(interaction: discord.Interaction, days: int):
 @tree.command(name="toggle_autodelete", description="Bật/tắt tự xóa embed cũ.")
 @app_commands.checks.has_permissions(administrator=True)
 async def toggle_autodelete(interaction: discord.Interaction):
-    config["AUTO_DELETE_ENABLED"] = not config["AUTO_DELETE_ENABLED"]
-    save_config(config)
-    status = "✅ BẬT" if config["AUTO_DELETE_ENABLED"] else "❌ TẮT"
+    enabled = not settings.get(interaction.guild_id).auto_delete_enabled
+    settings.update(interaction.guild_id, auto_delete_enabled=enabled)
+    status = "✅ BẬT" if enabled else "❌ TẮT"
     embed = make_embed("⚙️ Cập nhật cài đặt", f"Tự xóa embed hiện đang: **{status}**")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+# ===== /config_info & /setconfig =====
+def make_settings_embed(guild: discord.Guild, title: str) -> discord.Embed:
+    cfg = settings.get(guild.id)
+    excluded = ", ".join(f"<@&{role_id}>" for role_id in cfg.excluded_roles) or "—"
+    embed = make_embed(title)
+    embed.add_field(name="Số ngày inactive", value=f"**{cfg.inactive_days}**")
+    embed.add_field(name="Role ngủ đông", value=f"`{cfg.role_name}`")
+    embed.add_field(name="Tự xóa embed",
+                    value=f"{'✅ BẬT' if cfg.auto_delete_enabled else '❌ TẮT'} • {cfg.auto_delete_delay}s")
+    embed.add_field(name="Role được miễn", value=excluded, inline=False)
+    return embed
+
+@tree.command(name="config_info", description="Xem cài đặt của server.")
+@app_commands.checks.has_permissions(administrator=True)
+async def config_info(interaction: discord.Interaction):
+    await interaction.response.send_message(
+        embed=make_settings_embed(interaction.guild, "⚙️ Cài đặt server"), ephemeral=True)
+
+@tree.command(name="setconfig", description="Chỉnh cài đặt của server.")
+@app_commands.describe(role_name="Tên role ngủ đông",
+                       autodelete_delay="Số giây trước khi tự xóa embed",
+                       exclude_role="Bật/tắt miễn gán role ngủ đông cho role này")
+@app_commands.checks.has_permissions(administrator=True)
+async def setconfig(interaction: discord.Interaction,
+                    role_name: str = None,
+                    autodelete_delay: app_commands.Range[int, 1, 3600] = None,
+                    exclude_role: discord.Role = None):
+    changes = {}
+    if role_name:
+        changes["role_name"] = role_name
+    if autodelete_delay is not None:
+        changes["auto_delete_delay"] = autodelete_delay
+    if exclude_role is not None:
+        excluded = list(settings.get(interaction.guild_id).excluded_roles)
+        if exclude_role.id in excluded:
+            excluded.remove(exclude_role.id)
+        else:
+            excluded.append(exclude_role.id)
+        changes["excluded_roles"] = tuple(excluded)
+    if changes:
+        settings.update(interaction.guild_id, **changes)
+    if "role_name" in changes:
+        count_hibernating(interaction.guild)
+    await interaction.response.send_message(
+        embed=make_settings_embed(interaction.guild, "✅ Cập nhật thành công"), ephemeral=True)
+
 # ===== /status =====
 @tree.command(name="status", description="Xem số lượng user đang bị role ngủ đông.")
 async def slash_status(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
-    role_name = "💤 Tín Đồ Ngủ Đông"
     guild = interaction.guild
+    role_name = settings.get(guild.id).role_name
     role = discord.utils.get(guild.roles, name=role_name)
     if not role:
         await interaction.followup.send(f"❌ Không tìm thấy role `{role_name}` trong server.")
         return
-    members = [m for m in guild.members if role in m.roles]
+    hibernating = hibernating_count(guild.id)
     embed = make_embed("💤 Trạng thái ngủ đông",
-                       f"Hiện có **{len(members)}** thành viên đang có role `{role_name}`.")
+                       f"Hiện có **{hibernating}** thành viên đang có role `{role_name}`.")
+    await interaction.followup.send(embed=embed)
+
+# ===== /stats =====
+@tree.command(name="stats", description="Thống kê thành viên theo số ngày offline.")
+async def slash_stats(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+    stats = guild_stats[interaction.guild_id]
+    embed = make_embed("📊 Thống kê inactivity",
+                       f"Đang theo dõi **{len(stats.last_seen)}** thành viên • "
+                       f"**{hibernating_count(interaction.guild_id)}** có role `{settings.get(interaction.guild_id).role_name}`.")
+    for label, count in stats.histogram():
+        embed.add_field(name=label, value=f"**{count}**")
+    await interaction.followup.send(embed=embed)
+
+# ===== Log activity & /activity_trend =====
+# Tracker flush ghi thêm vào bảng activity_YYYYMMDD; compactor gom thành activity_daily/weekly
+# rồi DROP bảng log quá hạn. /activity_trend chỉ đọc bảng tổng hợp.
+ACTIVITY_RETENTION_DAYS = max(14, int(os.getenv("ACTIVITY_RETENTION_DAYS", 35)))  # ≥ 2 tuần cho rollup tuần
+ACTIVITY_DAILY_KEEP_DAYS = 400
+ACTIVITY_COMPACT_MINUTES = float(os.getenv("ACTIVITY_COMPACT_MINUTES", 30))
+TREND_BAR_WIDTH = 20
+
+def week_start(day: int) -> int:
+    """Epoch day của thứ Hai đầu tuần chứa `day` (epoch day 4 là thứ Hai)."""
+    return day - (day - 4) % 7
+
+async def compact_activity():
+    """Rollup các bảng log chưa chốt, rồi xóa bảng log quá hạn. Trả về (số ngày rollup, số bảng xóa)."""
+    today = today_epoch_day()
+    days = await db.activity_partitions()
+    rolled = int(await db.get_meta("activity_rolled_day") or -1)
+    fresh = [d for d in days if d > rolled]
+    for day in fresh:
+        await db.rollup_activity_day(day)
+    for week in sorted({week_start(d) for d in fresh}):
+        await db.rollup_activity_week(week, [d for d in days if week <= d < week + 7])
+    # Chừa hôm qua: flush ngay sau nửa đêm vẫn có thể ghi vào bảng của hôm qua
+    settled = [d for d in fresh if d < today - 1]
+    if settled:
+        await db.set_meta("activity_rolled_day", str(max(settled)))
+    expired = [d for d in days if d < today - ACTIVITY_RETENTION_DAYS]
+    await db.drop_activity_partitions(expired, today - ACTIVITY_DAILY_KEEP_DAYS)
+    return len(fresh), len(expired)
+
+@tree.command(name="activity_trend", description="Biểu đồ số thành viên hoạt động theo ngày/tuần.")
+@app_commands.describe(period="daily: theo ngày • weekly: theo tuần",
+                       span="Số ngày/tuần hiển thị")
+async def activity_trend(interaction: discord.Interaction,
+                         period: Literal["daily", "weekly"] = "daily",
+                         span: app_commands.Range[int, 2, 60] = 30):
+    await interaction.response.defer(ephemeral=True)
+    weekly = period == "weekly"
+    step = 7 if weekly else 1
+    end = week_start(today_epoch_day()) if weekly else today_epoch_day()
+    start = end - (span - 1) * step
+    title = f"📈 Thành viên hoạt động theo {'tuần' if weekly else 'ngày'}"
+    rows = {key: active for key, active, _ in await db.activity_trend(interaction.guild_id, weekly, start)}
+    if not rows:
+        await interaction.followup.send(embed=make_embed(title, "Chưa có dữ liệu tổng hợp."))
+        return
+
+    peak = max(rows.values()) or 1
+    lines = []
+    for key in range(start, end + 1, step):
+        active = rows.get(key, 0)
+        bar = "█" * round(active / peak * TREND_BAR_WIDTH)
+        lines.append(f"{from_epoch(key * DAY):%d/%m} {bar:<{TREND_BAR_WIDTH}} {active}")
+    embed = make_embed(title, "```\n" + "\n".join(lines) + "\n```")
+    embed.set_footer(text=f"Số liệu tổng hợp, cập nhật mỗi {ACTIVITY_COMPACT_MINUTES:g} phút")
     await interaction.followup.send(embed=embed)
 
 # ===== /exportcsv =====
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 2000))
+EXPORT_SPOOL_MEMORY = 4 * 1024 * 1024   # part lớn hơn mức này thì spool xuống đĩa
+EXPORT_SIZE_MARGIN = 1024 * 1024        # chừa chỗ cho dữ liệu gzip còn trong buffer
+CSV_HEADER = ["Guild_ID", "Member_ID", "Member_Name", "Last_Seen", "Role_Added"]
+
+class CsvGzipSplitter:
+    """Ghi CSV nén gzip vào SpooledTemporaryFile, tự mở part mới khi gần chạm `max_bytes`."""
+
+    def __init__(self, basename: str, max_bytes: int):
+        self.basename = basename
+        self.max_bytes = max_bytes
+        self.part_no = 0
+        self._spool = None
+        self._text = None
+        self._writer = None
+
+    def _open_part(self):
+        self.part_no += 1
+        self._spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MEMORY)
+        gz = gzip.GzipFile(filename=f"{self.basename}.csv", mode="wb", fileobj=self._spool)
+        self._text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(CSV_HEADER)
+
+    def _close_part(self):
+        # Đóng TextIOWrapper -> đóng GzipFile (ghi trailer), spool vẫn mở để upload
+        self._text.close()
+        spool, self._spool = self._spool, None
+        spool.seek(0)
+        return f"{self.basename}_part{self.part_no}.csv.gz", spool
+
+    def write(self, rows):
+        """Ghi một lô dòng, trả về list (filename, file) của các part đã đầy."""
+        if self._spool is None:
+            self._open_part()
+        self._writer.writerows(rows)
+        self._text.flush()
+        if self._spool.tell() + EXPORT_SIZE_MARGIN >= self.max_bytes:
+            return [self._close_part()]
+        return []
+
+    def finish(self):
+        return [self._close_part()] if self._spool is not None else []
+
+    def discard(self):
+        if self._spool is not None:
+            self._text.close()
+            self._spool.close()
+            self._spool = None
+
+async def _format_export_rows(rows):
+    """Đổi lô dòng DB thành dòng CSV, tra tên theo lô cho từng guild."""
+    by_guild = defaultdict(list)
+    for guild_id, member_id, _, _ in rows:
+        by_guild[guild_id].append(member_id)
+    names = {guild_id: await name_cache.resolve(guild_id, member_ids)
+             for guild_id, member_ids in by_guild.items()}
+    return [[guild_id, member_id, names[guild_id].get(member_id, "Unknown"),
+             from_epoch(last_seen).isoformat(),
+             from_epoch(role_added).isoformat() if role_added else ""]
+            for guild_id, member_id, last_seen, role_added in rows]
+
 @tree.command(name="exportcsv", description="Xuất dữ liệu inactivity thành file CSV.")
+@app_commands.describe(scope="server: chỉ server này • all: mọi server (chỉ chủ bot)",
+                       days="Chỉ xuất thành viên offline ≥ số ngày này (0 = tất cả)")
 @app_commands.checks.has_permissions(administrator=True)
-async def exportcsv(interaction: discord.Interaction):
-    await interaction.response.defer()
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT member_id, guild_id, last_seen, role_added FROM inactivity")
-    rows = c.fetchall()
-    conn.close()
-
-    if not rows:
-        embed = make_embed("❌ Xuất CSV", "Database rỗng, không có dữ liệu để xuất.")
-        sent = await interaction.followup.send(embed=embed)
-        last_command_msg_id[interaction.channel_id] = sent.id
-        await schedule_autodelete(interaction.channel_id, sent.id)
+async def exportcsv(interaction: discord.Interaction,
+                    scope: Literal["server", "all"] = "server",
+                    days: app_commands.Range[int, 0, 3650] = 0):
+    # Dữ liệu mọi server chỉ dành cho chủ bot, không cho admin của từng server
+    if scope == "all" and not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("❌ Chỉ chủ bot mới xuất được dữ liệu mọi server.",
+                                                ephemeral=True)
         return
+    await interaction.response.defer()
+    guild_id = interaction.guild_id if scope == "server" else None
+    cutoff = to_epoch(datetime.now(timezone.utc) - timedelta(days=days)) if days else None
+    max_bytes = interaction.guild.filesize_limit if interaction.guild else 10 * 1024 * 1024
+    splitter = CsvGzipSplitter(f"inactivity_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}", max_bytes)
 
-    csv_file_path = BASE_DIR / f"inactivity_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    with open(csv_file_path, mode="w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(["Guild_ID", "Member_ID", "Member_Name", "Last_Seen", "Role_Added"])
-        for member_id, guild_id, last_seen, role_added in rows:
-            guild = bot.get_guild(int(guild_id))
-            member_name = "Unknown"
-            if guild:
-                member = guild.get_member(int(member_id))
-                if member:
-                    member_name = member.display_name
-            writer.writerow([guild_id, member_id, member_name, last_seen, role_added])
+    async def send_parts(parts):
+        for filename, spool in parts:
+            try:
+                sent = await interaction.followup.send(file=discord.File(spool, filename=filename))
+            finally:
+                spool.close()
+            last_command_msg_id[interaction.channel_id] = sent.id
+            await schedule_autodelete(interaction, sent)
 
+    total = 0
     try:
-        sent = await interaction.followup.send(file=discord.File(csv_file_path))
-        last_command_msg_id[interaction.channel_id] = sent.id
-        await schedule_autodelete(interaction.channel_id, sent.id)
+        async for rows in db.iter_inactivity(guild_id, cutoff, EXPORT_CHUNK_ROWS):
+            total += len(rows)
+            lines = await _format_export_rows(rows)
+            await send_parts(await asyncio.to_thread(splitter.write, lines))
+        if total:
+            await send_parts(await asyncio.to_thread(splitter.finish))
     except Exception as e:
         embed = make_embed("❌ Lỗi", f"Không thể gửi file CSV: {e}")
         sent = await interaction.followup.send(embed=embed)
         last_command_msg_id[interaction.channel_id] = sent.id
-        await schedule_autodelete(interaction.channel_id, sent.id)
+        await schedule_autodelete(interaction, sent)
+        return
+    finally:
+        splitter.discard()
 
-    try:
-        os.remove(csv_file_path)
-    except Exception as e:
-        print(f"⚠️ Không thể xóa file CSV tạm: {e}")
+    if not total:
+        embed = make_embed("❌ Xuất CSV", "Database rỗng, không có dữ liệu để xuất.")
+        sent = await interaction.followup.send(embed=embed)
+        last_command_msg_id[interaction.channel_id] = sent.id
+        await schedule_autodelete(interaction, sent)
 
 # ===== /help paginate =====
 @tree.command(name="help", description="Hiển thị danh sách lệnh của Skibidi Bot (tương tác paginate).")
@@ -209,11 +1345,16 @@ async def slash_help(interaction: discord.Interaction):
     commands_list = [
         ("/setinactive", "Chỉnh số ngày inactive để kiểm tra."),
         ("/toggle_autodelete", "Bật/tắt tự xóa embed."),
+        ("/config_info", "Xem cài đặt của server."),
+        ("/setconfig", "Chỉnh role, thời gian tự xóa, role được miễn."),
         ("/status", "Xem số lượng user đang có role ngủ đông."),
+        ("/stats", "Thống kê thành viên theo số ngày offline."),
+        ("/activity_trend", "Biểu đồ thành viên hoạt động theo ngày/tuần."),
         ("/exportcsv", "Xuất file CSV dữ liệu inactivity."),
         ("/runcheck", "Kiểm tra inactivity thủ công."),
+        ("/backfill", "Đọc lịch sử tin nhắn để điền dữ liệu hoạt động."),
         ("/recheck30days", "Kiểm tra lại người offline ≥30 ngày."),
-        ("/list_off", "Danh sách offline ≥1 ngày."),
+        ("/list_off", "Danh sách offline ≥N ngày (mặc định 1)."),
         ("/list_off_30days", "Danh sách offline ≥30 ngày."),
         ("/exportdb", "Xuất database SQLite.")
     ]
@@ -266,157 +1407,292 @@ async def slash_help(interaction: discord.Interaction):
     embed = make_help_embed(0)
     await interaction.followup.send(embed=embed, view=view, ephemeral=True)
 
-# ===== /list_off (paginate) =====
-@tree.command(name="list_off", description="Danh sách offline ≥1 ngày (paginate).")
-@app_commands.checks.has_permissions(administrator=True)
-async def list_off(interaction: discord.Interaction):
-    await interaction.response.defer(ephemeral=True)
-    days_limit = 1
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days_limit)
-
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT member_id, guild_id, last_seen FROM inactivity")
-    rows = c.fetchall()
-    conn.close()
-
-    offline_members = []
-    for member_id, guild_id, last_seen in rows:
-        last_seen_dt = datetime.fromisoformat(last_seen)
-        if last_seen_dt <= cutoff:
-            guild = bot.get_guild(int(guild_id))
-            member_name = "Unknown"
-            if guild:
-                member = guild.get_member(int(member_id))
-                if member:
-                    member_name = member.display_name
-            offline_members.append(f"{member_name} ({member_id})")
-
-    if not offline_members:
-        embed = make_embed("💤 Offline ≥1 ngày", "Không có thành viên offline ≥1 ngày.")
-        sent = await interaction.followup.send(embed=embed, ephemeral=True)
-        await schedule_autodelete(interaction.channel_id, sent.id)
-        return
+# ===== Paginator dùng chung =====
+class LazyPaginator(discord.ui.View):
+    """Phân trang lazy: chỉ tải trang đang xem, cache trang đã xem.
+
+    `fetch(after, skip, limit, from_end)` trả về list (key, line); `key` là khóa keyset
+    của dòng, khóa cuối mỗi trang được nhớ để trang kế tiếp chỉ cần một truy vấn nhỏ.
+    """
+
+    def __init__(self, title: str, total: int, fetch, page_size: int = 25, timeout: float = 120):
+        super().__init__(timeout=timeout)
+        self.title = title
+        self.total = total
+        self.fetch = fetch
+        self.page_size = page_size
+        self.total_pages = max(1, -(-total // page_size))
+        self.current_page = 0
+        self.pages = {}
+        self.last_keys = {}
+
+    async def load_page(self, idx: int) -> list:
+        if idx in self.pages:
+            return self.pages[idx]
+        if idx == self.total_pages - 1 and idx - 1 not in self.last_keys:
+            remaining = self.total - idx * self.page_size
+            rows = await self.fetch(None, 0, remaining, True)
+        else:
+            # Bắt đầu từ trang đã biết gần nhất phía trước, phần còn lại bỏ qua bằng OFFSET
+            base = max((i for i in self.last_keys if i < idx), default=None)
+            after = self.last_keys[base] if base is not None else None
+            skip = (idx - (base + 1 if base is not None else 0)) * self.page_size
+            rows = await self.fetch(after, skip, self.page_size, False)
+        self.pages[idx] = [line for _, line in rows]
+        if rows:
+            self.last_keys[idx] = rows[-1][0]
+        return self.pages[idx]
+
+    async def make_page_embed(self) -> discord.Embed:
+        lines = await self.load_page(self.current_page)
+        return make_embed(f"{self.title} (Trang {self.current_page+1}/{self.total_pages})", "\n".join(lines))
+
+    async def show(self, interaction: discord.Interaction, page_idx: int):
+        self.current_page = min(max(page_idx, 0), self.total_pages - 1)
+        embed = await self.make_page_embed()
+        try:
+            await interaction.response.edit_message(embed=embed, view=self)
+        except discord.InteractionResponded:
+            await interaction.edit_original_response(embed=embed, view=self)
 
-    PAGE_SIZE = 25
-    pages = [offline_members[i:i + PAGE_SIZE] for i in range(0, len(offline_members), PAGE_SIZE)]
-    total_pages = len(pages)
+    @discord.ui.button(label="⏮", style=discord.ButtonStyle.gray)
+    async def first_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, 0)
 
-    def make_embed_page(page_idx):
-        desc = "\n".join(pages[page_idx])
-        embed = make_embed(f"💤 Offline ≥1 ngày (Trang {page_idx+1}/{total_pages})", desc)
-        return embed
+    @discord.ui.button(label="⬅ Trước", style=discord.ButtonStyle.gray)
+    async def back_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.current_page - 1)
 
-    class PaginateView(discord.ui.View):
-        def __init__(self):
-            super().__init__(timeout=120)
-            self.current_page = 0
+    @discord.ui.button(label="Tiếp ➡", style=discord.ButtonStyle.gray)
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.current_page + 1)
 
-        async def update_message(self, interaction: discord.Interaction):
-            try:
-                await interaction.response.edit_message(embed=make_embed_page(self.current_page), view=self)
-            except discord.InteractionResponded:
-                await interaction.edit_original_response(embed=make_embed_page(self.current_page), view=self)
+    @discord.ui.button(label="⏭", style=discord.ButtonStyle.gray)
+    async def last_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.total_pages - 1)
 
-        @discord.ui.button(label="⬅ Trước", style=discord.ButtonStyle.gray)
-        async def back_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-            if self.current_page > 0:
-                self.current_page -= 1
-                await self.update_message(interaction)
+    @discord.ui.button(label="🔢 Tới trang", style=discord.ButtonStyle.blurple)
+    async def jump_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.send_modal(JumpToPageModal(self))
 
-        @discord.ui.button(label="Tiếp ➡", style=discord.ButtonStyle.gray)
-        async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-            if self.current_page < total_pages - 1:
-                self.current_page += 1
-                await self.update_message(interaction)
-
-    view = PaginateView()
-    sent = await interaction.followup.send(embed=make_embed_page(0), view=view, ephemeral=True)
-    await schedule_autodelete(interaction.channel_id, sent.id)
+class JumpToPageModal(discord.ui.Modal, title="Tới trang"):
+    page = discord.ui.TextInput(label="Số trang", max_length=6)
 
-# ===== /list_off_30days (paginate) =====
-@tree.command(name="list_off_30days", description="Danh sách offline ≥30 ngày (paginate).")
-@app_commands.checks.has_permissions(administrator=True)
-async def list_off_30days(interaction: discord.Interaction):
-    await interaction.response.defer(ephemeral=True)
-    days_limit = 30
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days_limit)
-
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT member_id, guild_id, last_seen FROM inactivity")
-    rows = c.fetchall()
-    conn.close()
-
-    offline_members = []
-    for member_id, guild_id, last_seen in rows:
-        last_seen_dt = datetime.fromisoformat(last_seen)
-        if last_seen_dt <= cutoff:
-            guild = bot.get_guild(int(guild_id))
-            member_name = "Unknown"
-            if guild:
-                member = guild.get_member(int(member_id))
-                if member:
-                    member_name = member.display_name
-            offline_members.append(f"{member_name} ({member_id})")
-
-    if not offline_members:
-        embed = make_embed("💤 Offline ≥30 ngày", "Không có thành viên offline ≥30 ngày.")
-        sent = await interaction.followup.send(embed=embed, ephemeral=True)
-        await schedule_autodelete(interaction.channel_id, sent.id)
-        return
+    def __init__(self, paginator: LazyPaginator):
+        super().__init__()
+        self.paginator = paginator
+        self.page.placeholder = f"1 - {paginator.total_pages}"
 
-    PAGE_SIZE = 25
-    pages = [offline_members[i:i + PAGE_SIZE] for i in range(0, len(offline_members), PAGE_SIZE)]
-    total_pages = len(pages)
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            page_no = int(self.page.value)
+        except ValueError:
+            await interaction.response.send_message("❌ Số trang không hợp lệ.", ephemeral=True)
+            return
+        await self.paginator.show(interaction, page_no - 1)
 
-    def make_embed_page(page_idx):
-        desc = "\n".join(pages[page_idx])
-        embed = make_embed(f"💤 Offline ≥30 ngày (Trang {page_idx+1}/{total_pages})", desc)
-        return embed
+# ===== /list_off (paginate) =====
+async def send_offline_list(interaction: discord.Interaction, days_limit: int):
+    cutoff = to_epoch(datetime.now(timezone.utc) - timedelta(days=days_limit))
+    guild = interaction.guild
+    title = f"💤 Offline ≥{days_limit} ngày"
 
-    class PaginateView(discord.ui.View):
-        def __init__(self):
-            super().__init__(timeout=120)
-            self.current_page = 0
+    total = await db.count_offline(guild.id, cutoff)
+    if not total:
+        embed = make_embed(title, f"Không có thành viên offline ≥{days_limit} ngày.")
+        sent = await interaction.followup.send(embed=embed, ephemeral=True)
+        await schedule_autodelete(interaction, sent)
+        return
 
-        async def update_message(self, interaction: discord.Interaction):
-            try:
-                await interaction.response.edit_message(embed=make_embed_page(self.current_page), view=self)
-            except discord.InteractionResponded:
-                await interaction.edit_original_response(embed=make_embed_page(self.current_page), view=self)
+    async def fetch(after, skip, limit, from_end):
+        rows = await db.offline_page(guild.id, cutoff, limit, after=after, skip=skip, from_end=from_end)
+        names = await name_cache.resolve(guild.id, [member_id for _, member_id in rows], fetch_missing=True)
+        return [((last_seen, member_id), f"{names.get(member_id, 'Unknown')} ({member_id})")
+                for last_seen, member_id in rows]
 
-        @discord.ui.button(label="⬅ Trước", style=discord.ButtonStyle.gray)
-        async def back_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-            if self.current_page > 0:
-                self.current_page -= 1
-                await self.update_message(interaction)
+    view = LazyPaginator(title, total, fetch)
+    sent = await interaction.followup.send(embed=await view.make_page_embed(), view=view, ephemeral=True)
+    # Giữ bảng phân trang tới khi view hết hạn
+    await schedule_autodelete(interaction, sent, delay=view.timeout)
 
-        @discord.ui.button(label="Tiếp ➡", style=discord.ButtonStyle.gray)
-        async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-            if self.current_page < total_pages - 1:
-                self.current_page += 1
-                await self.update_message(interaction)
+@tree.command(name="list_off", description="Danh sách offline ≥N ngày (paginate).")
+@app_commands.describe(days="Số ngày offline tối thiểu (mặc định 1)")
+@app_commands.checks.has_permissions(administrator=True)
+async def list_off(interaction: discord.Interaction, days: app_commands.Range[int, 1, 3650] = 1):
+    await interaction.response.defer(ephemeral=True)
+    await send_offline_list(interaction, days)
 
-    view = PaginateView()
-    sent = await interaction.followup.send(embed=make_embed_page(0), view=view, ephemeral=True)
-    await schedule_autodelete(interaction.channel_id, sent.id)
+# ===== /list_off_30days (paginate) =====
+@tree.command(name="list_off_30days", description="Danh sách offline ≥30 ngày (paginate).")
+@app_commands.checks.has_permissions(administrator=True)
+async def list_off_30days(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+    await send_offline_list(interaction, 30)
 
 # ===== /runcheck =====
 @tree.command(name="runcheck", description="Kiểm tra inactivity thủ công.")
 @app_commands.checks.has_permissions(administrator=True)
 async def runcheck(interaction: discord.Interaction):
     await interaction.response.defer()
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT member_id, guild_id, last_seen FROM inactivity")
-    rows = c.fetchall()
-    conn.close()
-
-    embed = make_embed("✅ Kiểm tra Inactivity", f"Đã kiểm tra **{len(rows)}** thành viên trong DB.")
+    started = time.perf_counter()
+    result = await check_guild(interaction.guild, force=True)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    description = (f"Đã xử lý **{result['processed']}** entry trong **{elapsed_ms:.1f} ms**.\n"
+                   f"💤 Thêm role: **{result['added']}** • ☀️ Gỡ role: **{result['removed']}**")
+    if interaction.guild_id in role_blocked:
+        description += "\n⚠️ Bot thiếu quyền Manage Roles hoặc role ngủ đông nằm trên role của bot."
+    embed = make_embed("✅ Kiểm tra Inactivity", description)
     sent = await interaction.followup.send(embed=embed)
     last_command_msg_id[interaction.channel_id] = sent.id
-    await schedule_autodelete(interaction.channel_id, sent.id)
+    await schedule_autodelete(interaction, sent)
+
+# ===== /backfill =====
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", 8))  # số kênh đọc song song
+BACKFILL_FLUSH_MESSAGES = 1000   # ghi DB + cursor sau mỗi N tin của một kênh
+BACKFILL_PROGRESS_INTERVAL = 5   # giây giữa hai lần sửa tin tiến độ
+backfill_locks = defaultdict(asyncio.Lock)
+backfill_runs = set()  # gather worker của các /backfill đang chạy, để close() hủy được
+
+async def backfill_channel(channel, since: datetime, cursor, progress: dict):
+    """Đọc lùi lịch sử một kênh từ `cursor` về `since`, ghi last_seen mới nhất của từng người.
+
+    Mỗi BACKFILL_FLUSH_MESSAGES tin: upsert last_seen và lưu cursor trong cùng transaction,
+    nên chạy lại sẽ tiếp từ tin cũ nhất đã ghi. Rate limit do discord.py tự chờ theo bucket.
+    """
+    guild_id = channel.guild.id
+    latest, scanned, before_id = {}, 0, cursor
+    since_ts = to_epoch(since)
+
+    async def flush(done: bool):
+        rows = [(guild_id, member_id, ts) for member_id, ts in latest.items()]
+        await db.save_backfill(guild_id, channel.id, before_id, done, since_ts, rows)
+        for _, member_id, ts in rows:
+            merge_seen(guild_id, member_id, ts)
+        progress["members"].update(latest)
+        latest.clear()
+
+    before = discord.Object(id=cursor) if cursor else None
+    async for message in channel.history(limit=None, before=before, after=since, oldest_first=False):
+        before_id = message.id
+        scanned += 1
+        progress["messages"] += 1
+        if not message.author.bot and not message.webhook_id:
+            ts = to_epoch(message.created_at)
+            if ts > latest.get(message.author.id, 0):
+                latest[message.author.id] = ts
+        if scanned % BACKFILL_FLUSH_MESSAGES == 0:
+            await flush(done=False)
+    await flush(done=True)
+
+def can_read_history(channel, me) -> bool:
+    perms = channel.permissions_for(me)
+    return perms.view_channel and perms.read_message_history
+
+async def backfill_sources(guild: discord.Guild, since: datetime) -> list:
+    """Kênh text/voice/stage, thread đang mở (kể cả bài forum) và thread public lưu trữ sau `since`."""
+    sources = [*guild.text_channels, *guild.voice_channels, *guild.stage_channels, *guild.threads]
+    known = {source.id for source in sources}
+    for parent in [*guild.text_channels, *guild.forums]:
+        if not can_read_history(parent, guild.me):
+            continue
+        try:
+            # Sắp theo lúc lưu trữ, mới trước: thread lưu trữ trước `since` không còn tin trong cửa sổ
+            async for thread in parent.archived_threads(limit=None):
+                if thread.archive_timestamp < since:
+                    break
+                if thread.id not in known:
+                    known.add(thread.id)
+                    sources.append(thread)
+        except discord.HTTPException as e:
+            print(f"⚠️ Không liệt kê được thread đã lưu trữ của #{parent.name}: {e}")
+    return sources
+
+def make_backfill_embed(progress: dict, finished: bool = False) -> discord.Embed:
+    elapsed = time.monotonic() - progress["started"]
+    title = "✅ Backfill xong" if finished else "⏳ Đang backfill lịch sử tin nhắn"
+    embed = make_embed(title, f"Kênh: **{progress['channels_done']}/{progress['channels_total']}** • "
+                              f"Tin đã đọc: **{progress['messages']:,}** • "
+                              f"Thành viên: **{len(progress['members']):,}**")
+    if progress["skipped"]:
+        embed.add_field(name="Bỏ qua (thiếu quyền)", value=f"**{progress['skipped']}** kênh")
+    embed.set_footer(text=f"{elapsed:.0f}s")
+    return embed
+
+@tree.command(name="backfill", description="Đọc lịch sử tin nhắn để điền last_seen cho thành viên.")
+@app_commands.describe(days="Chỉ đọc tin trong N ngày gần đây",
+                       restart="Bỏ tiến độ cũ, đọc lại từ đầu")
+@app_commands.checks.has_permissions(administrator=True)
+async def backfill(interaction: discord.Interaction,
+                   days: app_commands.Range[int, 1, 365] = 90,
+                   restart: bool = False):
+    guild = interaction.guild
+    lock = backfill_locks[guild.id]
+    if lock.locked():
+        await interaction.response.send_message("⏳ Backfill của server này đang chạy.", ephemeral=True)
+        return
+    async with lock:
+        progress = {"started": time.monotonic(), "messages": 0, "members": {}, "skipped": 0,
+                    "channels_total": 0, "channels_done": 0}
+        # Trả lời ngay: liệt kê thread đã lưu trữ có thể quá 3 giây cho phép của interaction.
+        # Tin tiến độ sửa bằng bot token (qua kênh), không phụ thuộc token interaction 15 phút
+        await interaction.response.send_message(embed=make_backfill_embed(progress))
+        status_msg = interaction.channel.get_partial_message((await interaction.original_response()).id)
+
+        if restart:
+            await db.reset_backfill(guild.id)
+        cursors = await db.load_backfill_cursors(guild.id)
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        since_ts = to_epoch(since)
+        channels, starts = [], {}
+        for channel in await backfill_sources(guild, since):
+            if not can_read_history(channel, guild.me):
+                progress["skipped"] += 1
+                continue
+            before_id, done, scanned_since = cursors.get(channel.id, (None, False, None))
+            if done:
+                if scanned_since is not None and scanned_since <= since_ts:
+                    continue  # lượt trước đã đọc phủ cả cửa sổ này
+                # Cửa sổ rộng hơn lần trước: đọc tiếp từ mốc cũ nhất đã đọc
+                before_id = (discord.utils.time_snowflake(from_epoch(scanned_since))
+                             if scanned_since is not None else None)
+            channels.append(channel)
+            starts[channel.id] = before_id
+        progress["channels_total"] = len(channels)
+
+        queue = asyncio.Queue()
+        for channel in channels:
+            queue.put_nowait(channel)
+
+        async def worker():
+            while not queue.empty():
+                channel = queue.get_nowait()
+                try:
+                    await backfill_channel(channel, since, starts[channel.id], progress)
+                except discord.Forbidden:
+                    progress["skipped"] += 1
+                except Exception as e:
+                    print(f"⚠️ Lỗi backfill #{channel.name}: {e}")
+                progress["channels_done"] += 1
+
+        async def report():
+            while True:
+                await asyncio.sleep(BACKFILL_PROGRESS_INTERVAL)
+                with contextlib.suppress(discord.HTTPException):
+                    await status_msg.edit(embed=make_backfill_embed(progress))
+
+        reporter = asyncio.create_task(report())
+        run = asyncio.gather(*(worker() for _ in range(min(BACKFILL_CONCURRENCY, queue.qsize()))))
+        backfill_runs.add(run)
+        try:
+            await run
+        finally:
+            backfill_runs.discard(run)
+            reporter.cancel()
+        with contextlib.suppress(discord.HTTPException):
+            await status_msg.edit(embed=make_backfill_embed(progress, finished=True))
+        print(f"📥 Backfill {guild.name}: {progress['messages']} tin, {len(progress['members'])} thành viên "
+              f"trong {time.monotonic() - progress['started']:.0f}s")
 
 # ===== /recheck30days =====
 @tree.command(name="recheck30days", description="Kiểm tra lại người offline ≥30 ngày.")
@@ -424,55 +1700,174 @@ async def runcheck(interaction: discord.Interaction):
 async def recheck30days(interaction: discord.Interaction):
     await interaction.response.defer()
     days_limit = 30
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days_limit)
-
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT member_id, guild_id, last_seen FROM inactivity")
-    rows = c.fetchall()
-    conn.close()
-
-    count = 0
-    for member_id, guild_id, last_seen in rows:
-        last_seen_dt = datetime.fromisoformat(last_seen)
-        if last_seen_dt <= cutoff:
-            count += 1
+    count = guild_stats[interaction.guild_id].offline_at_least(days_limit)
 
     embed = make_embed("📊 Recheck 30 days",
                        f"Hiện có **{count}** thành viên offline ≥{days_limit} ngày.")
     sent = await interaction.followup.send(embed=embed)
     last_command_msg_id[interaction.channel_id] = sent.id
-    await schedule_autodelete(interaction.channel_id, sent.id)
+    await schedule_autodelete(interaction, sent)
 
 # ===== /exportdb =====
 @tree.command(name="exportdb", description="Xuất database SQLite.")
+@app_commands.describe(compact="VACUUM bản sao cho gọn trước khi gửi",
+                       compress="Nén gzip trước khi gửi")
 @app_commands.checks.has_permissions(administrator=True)
-async def exportdb(interaction: discord.Interaction):
+async def exportdb(interaction: discord.Interaction, compact: bool = False, compress: bool = True):
     await interaction.response.defer()
-    db_file_path = DB_PATH
-    if not db_file_path.exists():
+    if not DB_PATH.exists():
         embed = make_embed("❌ Lỗi", "Database không tồn tại.")
         sent = await interaction.followup.send(embed=embed)
         last_command_msg_id[interaction.channel_id] = sent.id
-        await schedule_autodelete(interaction.channel_id, sent.id)
+        await schedule_autodelete(interaction, sent)
         return
 
-    try:
-        sent = await interaction.followup.send(file=discord.File(db_file_path))
-        last_command_msg_id[interaction.channel_id] = sent.id
-        await schedule_autodelete(interaction.channel_id, sent.id)
-    except Exception as e:
-        embed = make_embed("❌ Lỗi", f"Không thể gửi database: {e}")
-        sent = await interaction.followup.send(embed=embed)
-        last_command_msg_id[interaction.channel_id] = sent.id
-        await schedule_autodelete(interaction.channel_id, sent.id)
+    max_bytes = interaction.guild.filesize_limit if interaction.guild else 10 * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = pathlib.Path(tmp_dir) / f"inactivity_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+        try:
+            info = await db.snapshot(str(snapshot_path), compact=compact, compress=compress)
+            if info["bytes"] > max_bytes:
+                raise ValueError(f"file {info['bytes'] / 1024 / 1024:.1f} MB vượt giới hạn upload "
+                                 f"{max_bytes / 1024 / 1024:.0f} MB")
+            embed = make_embed("💾 Snapshot database",
+                               f"Đã chụp **{info['pages']}** page trong **{info['elapsed']:.2f}s**.")
+            embed.add_field(name="Kích thước", value=f"{info['bytes'] / 1024:.1f} KB")
+            embed.add_field(name="Compact", value="✅" if compact else "❌")
+            embed.add_field(name="Nén gzip", value="✅" if compress else "❌")
+            sent = await interaction.followup.send(embed=embed, file=discord.File(info["path"]))
+            last_command_msg_id[interaction.channel_id] = sent.id
+            await schedule_autodelete(interaction, sent)
+        except Exception as e:
+            embed = make_embed("❌ Lỗi", f"Không thể gửi database: {e}")
+            sent = await interaction.followup.send(embed=embed)
+            last_command_msg_id[interaction.channel_id] = sent.id
+            await schedule_autodelete(interaction, sent)
+
+# ===== Theo dõi hoạt động =====
+@bot.event
+async def on_message(message: discord.Message):
+    if message.guild and not message.author.bot:
+        record_activity(message.guild.id, message.author.id, message.created_at)
+        if isinstance(message.author, discord.Member):
+            name_cache.remember(message.author)
+    await bot.process_commands(message)
+
+@bot.event
+async def on_presence_update(before: discord.Member, after: discord.Member):
+    if LAZY_MEMBERS:
+        return  # on_raw_presence_update đã ghi nhận
+    if after.bot or after.status == discord.Status.offline:
+        return
+    record_activity(after.guild.id, after.id)
+
+@bot.event
+async def on_raw_presence_update(payload: discord.RawPresenceUpdateEvent):
+    # Chỉ bật ở LAZY_MEMBERS: member không có trong cache thì on_presence_update không chạy
+    if payload.guild_id is None or payload.status == discord.Status.offline:
+        return
+    guild = bot.get_guild(payload.guild_id)
+    member = guild.get_member(payload.user_id) if guild else None
+    if member and member.bot:
+        return
+    record_activity(payload.guild_id, payload.user_id)
+
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    if member.bot or after.channel is None:
+        return
+    record_activity(member.guild.id, member.id)
+
+# ===== Theo dõi role ngủ đông =====
+def _has_hibernate_role(member: discord.Member) -> bool:
+    role_name = settings.get(member.guild.id).role_name
+    return any(r.name == role_name for r in member.roles)
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.display_name != after.display_name:
+        name_cache.remember(after)
+    had, has = _has_hibernate_role(before), _has_hibernate_role(after)
+    if had != has:
+        guild_stats[after.guild.id].hibernating += 1 if has else -1
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    name_cache.remember(member)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    name_cache.remember(member)  # giữ tên cuối cùng cho người đã rời server
+    if _has_hibernate_role(member):
+        guild_stats[member.guild.id].hibernating -= 1
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    if role.name == settings.get(role.guild.id).role_name:
+        count_hibernating(role.guild)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    if role.name == settings.get(role.guild.id).role_name:
+        count_hibernating(role.guild)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    # Quyền hoặc vị trí role (kể cả role của bot) đổi: thử gán role lại ở tick sau
+    role_blocked.discard(after.guild.id)
+    if settings.get(after.guild.id).role_name in (before.name, after.name):
+        count_hibernating(after.guild)
+
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    count_hibernating(guild)
+
+# ===== Đo latency slash command =====
+def _interaction_age(interaction: discord.Interaction) -> float:
+    return (datetime.now(timezone.utc) - interaction.created_at).total_seconds()
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    command_latency.observe(_interaction_age(interaction), command.qualified_name)
+
+@tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    name = interaction.command.qualified_name if interaction.command else "unknown"
+    command_errors.inc(name)
+    command_latency.observe(_interaction_age(interaction), name)
+    # Handler mặc định log kèm traceback
+    await app_commands.CommandTree.on_error(tree, interaction, error)
 
 # ===== Khởi chạy bot =====
+async def sync_commands_if_changed():
+    """Chỉ sync slash command khi hash command tree khác lần sync trước (lưu trong DB)."""
+    payload = sorted((cmd.to_dict(tree) for cmd in tree.get_commands()), key=lambda c: c["name"])
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    key = f"command_tree_hash:{bot.application_id}"
+    if await db.get_meta(key) == digest:
+        print("⏭️ Command tree không đổi, bỏ qua sync.")
+        return
+    await tree.sync()
+    await db.set_meta(key, digest)
+    print("🔄 Đã sync slash command.")
+
 @bot.event
 async def on_ready():
-    await tree.sync()
+    # on_ready chạy lại mỗi lần reconnect: phần khởi tạo chỉ làm lần đầu
+    if getattr(bot, "stats_ready", False):
+        return
+    # Đếm role ngủ đông một lần; sau đó chỉ cập nhật qua event
+    for guild in bot.guilds:
+        count_hibernating(guild)
+    bot.stats_ready = True
+    startup_timings["gateway_ready"] = time.perf_counter() - STARTED_AT
+    timings = " • ".join(f"{name} {secs:.2f}s" for name, secs in startup_timings.items())
     print(f"✅ Skibidi Bot v6 đã sẵn sàng! Đăng nhập dưới: {bot.user}")
+    print(f"⏱️ Khởi động: {timings}")
     change_status.start()  # Bắt đầu vòng lặp status động
+    role_sweep.start()
+    if IS_PRIMARY_CLUSTER:
+        activity_compactor.start()
 
 # ===== Vòng lặp đổi status =====
 status_list = [
@@ -490,7 +1885,25 @@ async def change_status():
         activity=discord.Game(status)
     )
 
-TOKEN = os.getenv("TOKEN")
-print(f"[DEBUG] TOKEN loaded: {bool(TOKEN)}")
-bot.run(TOKEN)
+# ===== Vòng lặp sweep role =====
+@tasks.loop(minutes=ROLE_SWEEP_MINUTES)
+async def role_sweep():
+    await check_all_guilds()
+
+# ===== Vòng lặp rollup log activity =====
+@tasks.loop(minutes=ACTIVITY_COMPACT_MINUTES)
+async def activity_compactor():
+    try:
+        rolled, dropped = await compact_activity()
+    except Exception as e:
+        print(f"⚠️ Lỗi rollup activity: {e}")
+        return
+    if dropped:
+        print(f"🧹 Rollup activity: {rolled} ngày, xóa {dropped} bảng log cũ")
+
+if __name__ == "__main__":
+    start_health_server()
+    TOKEN = os.getenv("TOKEN")
+    print(f"[DEBUG] TOKEN loaded: {bool(TOKEN)}")
+    bot.run(TOKEN)
 